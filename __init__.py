@@ -1 +1,5 @@
-from .recognition import find_letters
+from .recognition import find_letters, recognize, annotate
+from .batch import find_letters_batch
+from .streaming import recognize_in_strips
+from .profiling import Profile
+from .frames import FrameRecognizer, recognize_frames
@@ -0,0 +1,155 @@
+"""
+Find letters on many images and print one JSON record per image.
+
+Examples:
+    python -m letters_recognition scans/ -j 8 -o detections.ndjson --manifest done.txt
+    python -m letters_recognition 'photos/**/*.jpg' --annotate-dir annotated/ --param coarse_factor=4
+"""
+import argparse
+import ast
+import glob
+import json
+import os
+import sys
+from concurrent.futures.process import BrokenProcessPool
+
+from .batch import find_letters_batch
+from .cache import ResultCache
+from .recognition import DEFAULT_PARAMETERS
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+
+def iter_image_paths(patterns):
+    """
+    :param patterns: list of image paths, directories (searched recursively) and glob patterns
+    :return: generator of image paths, each path is given once
+    """
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = (
+                os.path.join(directory, name)
+                for directory, subdirectories, names in sorted(os.walk(pattern))
+                for name in sorted(names) if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        elif os.path.exists(pattern):
+            paths = [pattern]
+        else:
+            paths = (path for path in sorted(glob.iglob(pattern, recursive=True)) if os.path.isfile(path))
+
+        for path in paths:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+def read_manifest(path):
+    """
+    :param path: path to manifest file with one processed image path on a line, it may not exist
+    :return: set of processed image paths
+    """
+    if path is None or not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as file:
+        return {line.rstrip('\n') for line in file if line.endswith('\n')}
+
+
+def parse_parameter(text):
+    """
+    :param text: 'name=value' string, value is Python literal or plain string
+    :return: (name, value) tuple
+    """
+    name, separator, value = text.partition('=')
+    if not separator or name not in DEFAULT_PARAMETERS:
+        raise argparse.ArgumentTypeError(f"expected name=value with name one of {', '.join(DEFAULT_PARAMETERS)}")
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def get_annotated_path(annotate_dir, path):
+    """
+    :return: path of annotated image, directories of image path are kept to avoid name collisions
+    """
+    relative = os.path.splitdrive(os.path.abspath(path))[1].lstrip(os.sep)
+    return os.path.join(annotate_dir, os.path.splitext(relative)[0] + '.png')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m letters_recognition', description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('paths', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-j', '--workers', type=int, help='number of worker processes, by default number of CPUs')
+    parser.add_argument('--chunksize', type=int, default=4, help='number of images sent to worker at once')
+    parser.add_argument('-o', '--output', help='file to write records to, standard output by default')
+    parser.add_argument('--json', action='store_true', help='write one JSON list instead of NDJSON records')
+    parser.add_argument('--annotate-dir', help='directory to save images with marked letters to')
+    parser.add_argument('--manifest', help='file with processed images, they are skipped when run is repeated')
+    parser.add_argument('--with-features', action='store_true', help='add features of letters to records')
+    parser.add_argument('--cache-dir', help='directory of detections cache shared by runs')
+    parser.add_argument('--cache-size', type=int, default=256, help='cache size limit in megabytes')
+    parser.add_argument('--param', type=parse_parameter, action='append', default=[], metavar='NAME=VALUE',
+                        help='pipeline parameter, see recognition.DEFAULT_PARAMETERS')
+    args = parser.parse_args(args)
+    if args.json and args.manifest:
+        parser.error('--manifest needs NDJSON output, records of resumed runs are appended to output')
+
+    done = read_manifest(args.manifest)
+    paths = (path for path in iter_image_paths(args.paths) if path not in done)
+
+    annotated_path = None
+    if args.annotate_dir:
+        def annotated_path(path):
+            output_path = get_annotated_path(args.annotate_dir, path)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            return output_path
+
+    output = open(args.output, 'a' if args.manifest else 'w', encoding='utf-8') if args.output else sys.stdout
+    manifest = open(args.manifest, 'a', encoding='utf-8') if args.manifest else None
+    records, failed = list(), 0
+    try:
+        results = find_letters_batch(
+            paths, workers=args.workers, chunksize=args.chunksize, annotate=False, annotated_path=annotated_path,
+            with_features=args.with_features,
+            cache=ResultCache(args.cache_dir, args.cache_size * 2 ** 20) if args.cache_dir else None, **dict(args.param)
+        )
+        for path, detections, error in results:
+            if error is None:
+                record = {'path': path, 'detections': [detection.to_dict() for detection in detections]}
+            else:
+                record = {'path': path, 'error': f'{type(error).__name__}: {error}'}
+                failed += 1
+
+            if args.json:
+                records.append(record)
+            else:
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+            # failed images, including ones which killed worker process, are not written to manifest,
+            # so they are tried again
+            if manifest is not None and error is None:
+                manifest.write(path + '\n')
+                manifest.flush()
+
+        if args.json:
+            json.dump(records, output, indent=2)
+            output.write('\n')
+    except BrokenProcessPool as error:
+        # images killing workers are reported by find_letters_batch, this is the case when pool can not work at all
+        print(f'{parser.prog}: error: worker processes failed: {error}', file=sys.stderr)
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if manifest is not None:
+            manifest.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import io
+import os
+from collections import deque
+from itertools import islice
+
+from .features import build_templates
+from . import recognition
+from .recognition import find_letters, recognize, get_font_data, get_parameters
+
+
+def _init_worker(parameters):
+    """
+    Prepare worker process: read font and make feature templates once for all images of worker
+    :param parameters: pipeline parameters
+    :return: None
+    """
+    get_font_data()
+    if parameters['canonical_grid']:
+        build_templates(parameters['canonical_grid'])
+
+
+def _process_chunk(chunk, annotate, parameters, output_paths=None):
+    """
+    Find letters on each image of chunk, errors of one image do not affect others
+    :param chunk: list of image paths or bytes of image files
+    :param annotate: if True results are images made by find_letters, else lists of detections
+    :param parameters: pipeline parameters
+    :param output_paths: list of paths to save annotated images to (None to skip image), results are detections then
+    :return: list of (result, error) tuples
+    """
+    process = find_letters if annotate else recognize
+    results = list()
+    for source, output_path in zip(chunk, output_paths or [None] * len(chunk)):
+        try:
+            if output_path is None:
+                result = process(io.BytesIO(source) if isinstance(source, bytes) else source, **parameters)
+            else:
+                result = recognize(source, **parameters)
+                recognition.annotate(recognition.as_pil_image(recognition.open_image(source)), result).save(
+                    output_path
+                )
+            results.append((result, None))
+        except Exception as error:
+            results.append((None, error))
+    return results
+
+
+def _read_source(source):
+    """
+    Open files can not be sent to worker process, so their content is sent instead
+    :param source: image path or open binary file
+    :return: path or bytes
+    """
+    if hasattr(source, 'read'):
+        return source.read()
+    return os.fspath(source)
+
+
+def find_letters_batch(sources, *, workers=None, chunksize=1, annotate=True, annotated_path=None, with_features=False,
+                       cache=None, **parameters):
+    """
+    Find letters on many images using pool of processes.
+    Results are given as soon as they are ready, so their order may differ from order of sources.
+    If a worker process dies, the pool is replaced and chunks which were running are tried again one at a time,
+    so only the image which kills worker gets BrokenProcessPool error.
+    :param sources: iterable of image paths or open binary files, it is read only as workers need new images
+    :param workers: number of worker processes, by default number of CPUs
+    :param chunksize: number of images sent to worker at once
+    :param annotate: if False results are lists of recognition.Detection objects made by recognize
+        instead of images, so annotated images are neither drawn nor sent between processes
+    :param annotated_path: function called with source, which gives path to save annotated image to or None.
+        If it is given, workers save annotated images themselves and results are lists of detections
+    :param with_features: if True detections have all features of letter instances
+    :param cache: cache.ResultCache object shared by workers, see recognition.recognize
+    :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS
+    :return: generator of (source, result, error) tuples, where result is image made by find_letters
+        and error is None, or result is None and error is exception raised for this source
+    """
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    parameters = get_parameters(**parameters)
+    workers = workers or os.cpu_count()
+    sources = iter(sources)
+
+    process_parameters = {**parameters, 'with_features': with_features, 'cache': cache}
+
+    def start_pool():
+        return ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(parameters,))
+
+    def submit(chunk, alone=False):
+        payload, _, output_paths = chunk
+        future = executor.submit(
+            _process_chunk, payload, annotate, process_parameters, output_paths if annotated_path else None
+        )
+        pending[future] = (chunk, alone)
+
+    executor = start_pool()
+    try:
+        # future: ((payload, sources, output paths), True if no other chunk was running with it)
+        pending = dict()
+        # chunks which were running when a worker died, they are run one at a time to find the one which kills it
+        suspects = deque()
+        while True:
+            broken = False
+            try:
+                if suspects:
+                    if not pending:
+                        submit(suspects[0], alone=True)
+                        suspects.popleft()
+                else:
+                    while len(pending) < 2 * workers:
+                        chunk = list(islice(sources, chunksize))
+                        if not chunk:
+                            break
+
+                        payload, chunk_sources, output_paths = list(), list(), list()
+                        for source in chunk:
+                            try:
+                                output_path = None if annotated_path is None else annotated_path(source)
+                                payload.append(_read_source(source))
+                                output_paths.append(output_path)
+                                chunk_sources.append(source)
+                            except Exception as error:
+                                yield source, None, error
+                        if payload:
+                            try:
+                                submit((payload, chunk_sources, output_paths))
+                            except BrokenProcessPool:
+                                suspects.append((payload, chunk_sources, output_paths))
+                                raise
+            except BrokenProcessPool:
+                broken = True
+
+            if not pending and not suspects:
+                return
+
+            done = wait(pending, return_when=FIRST_COMPLETED)[0] if pending else set()
+            while done:
+                for future in done:
+                    (payload, chunk_sources, output_paths), alone = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except BrokenProcessPool as error:
+                        broken = True
+                        if not alone:
+                            suspects.append((payload, chunk_sources, output_paths))
+                            continue
+                        if len(payload) > 1:
+                            # images of chunk are tried one by one, so only the one which kills worker fails
+                            singles = [([item], [source], [output_path])
+                                       for item, source, output_path in zip(payload, chunk_sources, output_paths)]
+                            suspects.extendleft(reversed(singles))
+                            continue
+                        results = [(None, error)]
+                    except Exception as error:
+                        # result could not be sent back
+                        results = [(None, error)] * len(chunk_sources)
+                    for source, (result, error) in zip(chunk_sources, results):
+                        yield source, result, error
+                # all futures of broken pool are finished, some of them before worker died
+                done = wait(pending)[0] if broken else set()
+
+            if broken:
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = start_pool()
+    finally:
+        executor.shutdown(cancel_futures=True)
@@ -0,0 +1,327 @@
+"""
+Benchmarks of recognition pipeline on synthetic pages drawn with bundled font.
+
+Run them by `python -m letters_recognition.benchmarks`, see `--help` for options.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from .features import LETTERS_DETERMINATION
+from .recognition import Detection, binarize_image, find_instances, classify_instances, create_output_image, \
+    get_parameters
+from .tools import get_package_dir_path, WHITE, BLACK
+
+
+STAGES = ('handle_image', 'find_instances', 'classify', 'create_output_image')
+
+BENCHMARK_CASES = {
+    'sparse': {'size': (800, 600), 'font_size': 40, 'density': 0.3},
+    'dense': {'size': (1600, 1200), 'font_size': 40, 'density': 1.0},
+    'noisy': {'size': (1600, 1200), 'font_size': 40, 'density': 0.5, 'noise': 0.005},
+    'high_resolution': {'size': (1600, 1200), 'font_size': 40, 'density': 0.5, 'scale': 2},
+}
+
+QUICK_CASES = {
+    'quick': {'size': (400, 300), 'font_size': 40, 'density': 0.5},
+}
+
+DEFAULT_MARGIN = 0.25
+
+# seconds to import package in fresh interpreter, numpy and PIL.Image included
+IMPORT_TIME_BUDGET = 0.5
+# modules needed only for drawing or pools of workers, they are imported on first use
+LAZY_MODULES = ('PIL.ImageDraw', 'PIL.ImageFont', 'multiprocessing', 'concurrent.futures', 'asyncio')
+
+
+def render_page(size=(800, 600), font_size=40, density=0.5, noise=0.0, scale=1, letters=None, seed=0):
+    """
+    Draw synthetic page with letters placed on grid
+    :param size: size of page in pixels before scaling
+    :param font_size: size of font before scaling
+    :param density: probability of grid cell to get a letter
+    :param noise: share of pixels turned into random black or white ones
+    :param scale: resolution multiplier of page and font
+    :param letters: letters to choose from, all determined letters by default
+    :param seed: seed of random generator
+    :return: (PIL.Image.Image object, list of (letter, bbox) tuples), bbox is (x_min, y_min, x_max, y_max)
+    """
+    letters = sorted(letters or LETTERS_DETERMINATION)
+    width, height = size[0] * scale, size[1] * scale
+    font_size *= scale
+    random = np.random.default_rng(seed)
+
+    image = Image.new('RGB', (width, height), WHITE)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype(os.path.join(get_package_dir_path(), 'OpenSans-Regular.ttf'), font_size)
+
+    truth = list()
+    cell_width, cell_height = font_size * 3 // 2, font_size * 8 // 5
+    for y in range(font_size // 4, height - cell_height + 1, cell_height):
+        for x in range(font_size // 4, width - cell_width + 1, cell_width):
+            if random.random() >= density:
+                continue
+            letter = letters[random.integers(len(letters))]
+            draw.text((x, y), letter, fill=BLACK, font=font)
+            truth.append((letter, draw.textbbox((x, y), letter, font=font)))
+
+    if noise:
+        pixels = np.array(image)
+        flipped = random.random((height, width)) < noise
+        pixels[flipped] = np.where(random.random(np.count_nonzero(flipped)) < 0.5, 0, 255)[:, None]
+        image = Image.fromarray(pixels)
+    return image, truth
+
+
+def _get_overlap(bbox1, bbox2):
+    width = min(bbox1[2], bbox2[2]) - max(bbox1[0], bbox2[0])
+    height = min(bbox1[3], bbox2[3]) - max(bbox1[1], bbox2[1])
+    if width <= 0 or height <= 0:
+        return 0
+    intersection = width * height
+    area1 = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1])
+    area2 = (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1])
+    return intersection / (area1 + area2 - intersection)
+
+
+def get_accuracy(detections, truth, min_overlap=0.5):
+    """
+    Compare detected letters with drawn ones
+    :param detections: list of (letter, bbox) tuples of found letters
+    :param truth: list of (letter, bbox) tuples of drawn letters
+    :param min_overlap: minimal intersection over union of boxes of matched letters
+    :return: dict with 'recall' (share of drawn letters found) and 'precision' (share of right detections)
+    """
+    unmatched = list(truth)
+    matched = 0
+    for letter, bbox in detections:
+        candidates = [(_get_overlap(bbox, true_bbox), i) for i, (true_letter, true_bbox) in enumerate(unmatched)
+                      if true_letter == letter]
+        overlap, i = max(candidates, default=(0, None))
+        if overlap >= min_overlap:
+            matched += 1
+            del unmatched[i]
+
+    return {
+        'recall': matched / len(truth) if truth else 1.0,
+        'precision': matched / len(detections) if detections else 1.0,
+    }
+
+
+def run_stages(image, **parameters):
+    """
+    Run pipeline stage by stage measuring time of each of them, stages are the same as recognize runs,
+    'handle_image' is time of binarize_image
+    :param image: PIL.Image.Image object
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: (dict of stage times in seconds, list of classified instances)
+    """
+    times = dict()
+
+    start = time.perf_counter()
+    mask = binarize_image(image, **parameters)
+    times['handle_image'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    instances = find_instances(mask, **parameters)
+    times['find_instances'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    classify_instances(instances, **parameters)
+    times['classify'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    create_output_image(image, instances)
+    times['create_output_image'] = time.perf_counter() - start
+    return times, instances
+
+
+def get_peak_memory(image, **parameters):
+    """
+    Measure peak of memory allocated by each pipeline stage
+    :param image: PIL.Image.Image object
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: dict of stage peak memory in bytes
+    """
+    def classify(instances):
+        classify_instances(instances, **parameters)
+        return instances
+
+    stages = {
+        'handle_image': lambda data: binarize_image(image, **parameters),
+        'find_instances': lambda mask: find_instances(mask, **parameters),
+        'classify': classify,
+        'create_output_image': lambda instances: create_output_image(image, instances),
+    }
+
+    peaks = dict()
+    data = None
+    tracemalloc.start()
+    try:
+        for name in STAGES:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            data = stages[name](data)
+            peaks[name] = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def run_case(case, repeat=3, **parameters):
+    """
+    Benchmark pipeline on synthetic page
+    :param case: dict of render_page arguments
+    :param repeat: number of runs, best time of each stage is taken
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: dict with stage times, peak memory, throughput and accuracy
+    """
+    parameters = get_parameters(**parameters)
+    image, truth = render_page(**case)
+
+    times = dict.fromkeys(STAGES, float('inf'))
+    for _ in range(repeat):
+        run_times, instances = run_stages(image, **parameters)
+        times = {name: min(times[name], run_times[name]) for name in STAGES}
+
+    detections = [(instance.letter, Detection.from_instance(instance).bbox)
+                  for instance in instances if instance.letter]
+    total_time = sum(times.values())
+    return {
+        'stages': times,
+        'peak_memory': get_peak_memory(image, **parameters),
+        'pixels_per_second': image.size[0] * image.size[1] / total_time,
+        'letters_per_second': len(truth) / total_time,
+        'letters': len(truth),
+        **get_accuracy(detections, truth),
+    }
+
+
+def run_benchmarks(cases=None, repeat=3, **parameters):
+    """
+    :param cases: dict of case names and render_page arguments, BENCHMARK_CASES by default
+    :param repeat: number of runs of each case
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: dict of case names and run_case results
+    """
+    cases = BENCHMARK_CASES if cases is None else cases
+    return {name: run_case(case, repeat, **parameters) for name, case in cases.items()}
+
+
+def compare_with_baseline(results, baseline, margin=DEFAULT_MARGIN):
+    """
+    Find stages which became slower than in baseline
+    :param results: run_benchmarks result
+    :param baseline: run_benchmarks result saved before
+    :param margin: allowed relative slowdown, 0.25 means 25%
+    :return: list of regression descriptions, empty if there is no one
+    """
+    regressions = list()
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for stage, seconds in result['stages'].items():
+            baseline_seconds = baseline[name]['stages'].get(stage)
+            if baseline_seconds is not None and seconds > baseline_seconds * (1 + margin):
+                regressions.append(f'{name}: {stage} takes {seconds:.4f}s, baseline is {baseline_seconds:.4f}s')
+        for metric in ('recall', 'precision'):
+            if result[metric] < baseline[name].get(metric, 0):
+                regressions.append(f'{name}: {metric} is {result[metric]:.3f}, '
+                                   f'baseline is {baseline[name][metric]:.3f}')
+    return regressions
+
+
+def measure_import(repeat=3):
+    """
+    Import package in fresh interpreters
+    :param repeat: number of interpreters, the fastest import is taken
+    :return: dict with 'import_time' in seconds and 'eager_modules', list of LAZY_MODULES imported with package
+    """
+    code = (
+        f'import sys, time; start = time.perf_counter(); import {__package__}; '
+        f'print(time.perf_counter() - start); print(*[name for name in {LAZY_MODULES!r} if name in sys.modules])'
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [os.path.dirname(get_package_dir_path()), os.environ.get('PYTHONPATH')])
+    ))
+    times = list()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        seconds, eager_modules = output.stdout.split('\n')[:2]
+        times.append(float(seconds))
+    return {'import_time': min(times), 'eager_modules': eager_modules.split()}
+
+
+def check_import(result, budget=IMPORT_TIME_BUDGET):
+    """
+    :param result: measure_import result
+    :param budget: allowed import time in seconds
+    :return: list of problem descriptions, empty if there is no one
+    """
+    problems = list()
+    if result['import_time'] > budget:
+        problems.append(f"import takes {result['import_time']:.3f}s, budget is {budget:.3f}s")
+    for name in result['eager_modules']:
+        problems.append(f'{name} is imported with package')
+    return problems
+
+
+def format_results(results):
+    lines = list()
+    for name, result in results.items():
+        lines.append(f"{name}: {result['letters']} letters, recall {result['recall']:.3f}, "
+                     f"precision {result['precision']:.3f}, {result['pixels_per_second'] / 1e6:.2f} Mpx/s, "
+                     f"{result['letters_per_second']:.1f} letters/s")
+        for stage in STAGES:
+            lines.append(f"    {stage:<20} {result['stages'][stage] * 1000:10.2f} ms "
+                         f"{result['peak_memory'][stage] / 2 ** 20:10.2f} MiB")
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m letters_recognition.benchmarks', description=__doc__.strip())
+    parser.add_argument('--quick', action='store_true', help='run only small page')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each case')
+    parser.add_argument('--baseline', help='JSON file with results to compare with')
+    parser.add_argument('--save-baseline', help='JSON file to save results to')
+    parser.add_argument('--margin', type=float, default=DEFAULT_MARGIN, help='allowed relative slowdown of stage')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_TIME_BUDGET,
+                        help='allowed import time of package in seconds')
+    args = parser.parse_args(args)
+
+    import_result = measure_import(args.repeat)
+    import_problems = check_import(import_result, args.import_budget)
+    for problem in import_problems:
+        print('IMPORT', problem, file=sys.stderr)
+
+    results = run_benchmarks(QUICK_CASES if args.quick else BENCHMARK_CASES, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"import: {import_result['import_time'] * 1000:.2f} ms")
+        print(format_results(results))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_with_baseline(results, json.load(file), args.margin)
+        for regression in regressions:
+            print('REGRESSION', regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 1 if import_problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
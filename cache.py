@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+from .features import LETTERS_DETERMINATION
+from .recognition import Detection, get_parameters
+from .tools import get_package_dir_path
+
+
+@lru_cache(maxsize=1)
+def get_code_fingerprint():
+    """
+    :return: hex digest of letters determination and source files of package, it changes with rules or code
+    """
+    digest = hashlib.sha256(json.dumps(LETTERS_DETERMINATION, sort_keys=True).encode())
+    package_dir = get_package_dir_path()
+    for name in sorted(os.listdir(package_dir)):
+        if name.endswith('.py'):
+            with open(os.path.join(package_dir, name), 'rb') as file:
+                digest.update(name.encode() + b'\0' + file.read())
+    return digest.hexdigest()
+
+
+def get_pixels_digest(img):
+    """
+    :param img: PIL.Image.Image object or numpy.ndarray given by recognition.open_image
+    :return: hex digest of decoded pixels, the same for the same pixels in any file format
+    """
+    if isinstance(img, Image.Image):
+        header, data = f'{img.mode} {img.size}', img.tobytes()
+    else:
+        header, data = f'{img.dtype.str} {img.shape}', np.ascontiguousarray(img).data
+    digest = hashlib.sha256(header.encode())
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Cache of detections on disk. Entry key is hash of image pixels, letters determination, package code and
+    pipeline parameters, so changes of rules or code make old entries unused. Entries are written atomically,
+    so the cache directory can be shared by processes. When the cache grows over max_size, least recently used
+    entries are removed.
+    """
+    def __init__(self, directory, max_size=256 * 2 ** 20):
+        """
+        :param directory: cache directory, it is made if it does not exist
+        :param max_size: limit of total size of entries in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, img, *, with_features=False, **parameters):
+        """
+        :param img: PIL.Image.Image object or numpy.ndarray given by recognition.open_image
+        :param with_features: if True detections of entry have features
+        :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS
+        :return: hex string key of entry
+        """
+        parameters = json.dumps({**get_parameters(**parameters), 'with_features': with_features}, sort_keys=True)
+        digest = hashlib.sha256(f'{get_code_fingerprint()} {parameters} {get_pixels_digest(img)}'.encode())
+        return digest.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :param key: key given by get_key
+        :return: list of Detection objects or None if there is no entry
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                records = json.loads(zlib.decompress(file.read()))
+            os.utime(path)
+        except (OSError, ValueError, zlib.error):
+            return None
+        return [Detection(letter, (x_min, y_min), (x_max - x_min, y_max - y_min), *features)
+                for letter, x_min, y_min, x_max, y_max, *features in records]
+
+    def put(self, key, detections):
+        """
+        :param key: key given by get_key
+        :param detections: list of Detection objects
+        :return: None
+        """
+        records = [[detection.letter, *detection.bbox] +
+                   ([detection.features] if detection.features is not None else [])
+                   for detection in detections]
+        data = zlib.compress(json.dumps(records, separators=(',', ':')).encode())
+
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._scan())
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            # some room is left, so the next entries do not make cache scanned again
+            self.evict(int(self.max_size * 0.9))
+
+    def _scan(self):
+        """
+        :return: list of (path, size, last access time) of entries
+        """
+        entries = list()
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self, max_size=None):
+        """
+        Remove least recently used entries, so total size is not more than max_size
+        :param max_size: size limit in bytes, by default max_size of cache
+        :return: None
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, _ in entries:
+            if size <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        self.evict(0)
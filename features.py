@@ -1,6 +1,14 @@
-from PIL import Image, ImageDraw
+from collections.abc import Mapping
+from functools import lru_cache
+from itertools import combinations
+from types import MappingProxyType
 
-from .tools import get_ellipse_pixels, get_A_slopping_lines_pixels, get_locality, WHITE, BLACK, RED, GREEN, BLUE
+import numpy as np
+from PIL import Image
+
+from .tools import get_ellipse_pixels, get_A_slopping_lines_pixels, get_locality, get_row_distances, \
+    get_l1_distances, get_band_distances, WHITE, BLACK, RED, GREEN, BLUE
+from .profiling import profile_stage
 
 
 LETTERS_DETERMINATION = {
@@ -112,90 +120,199 @@ LETTERS_DETERMINATION = {
 }
 
 
-def has_left_vertical_line(instance, *, _show_area=False):
+# feature functions by feature name, filled by register_feature
+FEATURE_FUNCS = dict()
+# functions making (verifying pixels, locality size) of feature for instance size, filled by register_template
+TEMPLATE_FUNCS = dict()
+
+
+def register_feature(func=None, *, name=None):
     """
-    True if instance image has a left vertical line.
-    :param instance: recognition.Instance object
-    :param _show_area: if True shows area of feature for instance
-    :return: True or False
+    Add feature function to registry, so instances are checked for the feature and it is in their features.
+    Can be used as decorator with or without arguments.
+    :param func: function taking recognition.Instance object and keyword arguments _show_area and with_distance
+    :param name: feature name, by default function name without 'has_' prefix
+    :return: func
+    :raise ValueError: if feature with the same name is registered
+    """
+    if func is None:
+        return lambda func: register_feature(func, name=name)
+
+    name = func.__name__.removeprefix('has_') if name is None else name
+    if name in FEATURE_FUNCS:
+        raise ValueError(f'feature {name} is registered already')
+    FEATURE_FUNCS[name] = func
+    return func
+
+
+def register_template(name):
+    """
+    Decorator adding template function of feature to registry, see get_template.
+    Feature with template is scaled as it is done by _scale_feature_with_verifying_pixels,
+    since find_features_batch scales such features by templates only.
+    :param name: feature name
+    :return: decorator returning function as it is
+    """
+    def decorator(func):
+        TEMPLATE_FUNCS[name] = func
+        get_template.cache_clear()
+        return func
+    return decorator
+
+
+# maximal number of (feature, instance size) templates kept in memory
+TEMPLATE_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_template(feature_name, size):
     """
-    size = instance.size
+    Get verifying pixels and locality size of feature for instances of given size.
+    Templates are made once for each size and are kept in LRU cache.
+    :param feature_name: name of feature without 'has_' prefix
+    :param size: (width, height) of instance
+    :return: tuple of read-only int array of verifying pixels (x, y) with shape (pixels, 2) and locality size
+    """
+    verifying_pixels, eps = TEMPLATE_FUNCS[feature_name](tuple(size))
+    verifying_pixels = np.array(sorted(verifying_pixels), dtype=np.int64).reshape(-1, 2)
+    verifying_pixels.flags.writeable = False
+    return verifying_pixels, tuple(eps) if np.ndim(eps) > 0 else eps
+
+
+def build_templates(size):
+    """
+    Make templates of all features with templates for instances of given size beforehand
+    :param size: (width, height) of instance
+    :return: None
+    """
+    for name in get_feature_funcs():
+        if name in TEMPLATE_FUNCS:
+            get_template(name, tuple(size))
+
+
+@register_template('left_vertical_line')
+def _left_vertical_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     verifying_pixels = {(bbox[0], i) for i in range(bbox[1], bbox[3])}
 
     eps = (size[0] // 10, size[1] // 11)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_middle_vertical_line(instance, *, _show_area=False):
+@register_feature
+def has_left_vertical_line(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has a middle vertical line.
+    True if instance image has a left vertical line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('left_vertical_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('middle_vertical_line')
+def _middle_vertical_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     middle_x = (bbox[2] + bbox[0]) // 2
     verifying_pixels = {(middle_x, i) for i in range(bbox[1], bbox[3])}
 
     eps = (size[0] // 8, size[1] // 13)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_right_vertical_line(instance, *, _show_area=False):
+@register_feature
+def has_middle_vertical_line(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has a right vertical line.
+    True if instance image has a middle vertical line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('middle_vertical_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('right_vertical_line')
+def _right_vertical_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     verifying_pixels = {(bbox[2] - 1, i) for i in range(bbox[1], bbox[3])}
 
     eps = (size[0] // 10, size[1] // 11)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_upper_horizont_line(instance, *, _show_area=False):
+@register_feature
+def has_right_vertical_line(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has a upper horizontal line.
+    True if instance image has a right vertical line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('right_vertical_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('upper_horizont_line')
+def _upper_horizont_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     verifying_pixels = {(i, bbox[1]) for i in range(bbox[0], bbox[2])}
 
     eps = (size[0] // 11, size[1] // 10)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_bottom_horizont_line(instance, *, _show_area=False):
+@register_feature
+def has_upper_horizont_line(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has a bottom horizontal line.
+    True if instance image has a upper horizontal line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('upper_horizont_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('bottom_horizont_line')
+def _bottom_horizont_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     verifying_pixels = {(i, bbox[3] - 1) for i in range(bbox[0], bbox[2])}
 
     eps = (size[0] // 11, size[1] // 10)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_1_part_horizont_line(instance, *, _show_area=False):
+@register_feature
+def has_bottom_horizont_line(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has the first part of middle horizontal line.
+    True if instance image has a bottom horizontal line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('bottom_horizont_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('1_part_horizont_line')
+def _1_part_horizont_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -203,18 +320,26 @@ def has_1_part_horizont_line(instance, *, _show_area=False):
     verifying_pixels = {(i, middle_y) for i in range(bbox[0], bbox[0] + bbox_size[0] * 2 // 5)}
 
     eps = (size[0] // 19, size[1] // 6)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
-
+    return verifying_pixels, eps
 
-def has_2_part_horizont_line(instance, *, _show_area=False):
 
+@register_feature
+def has_1_part_horizont_line(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has the second part of middle horizontal line.
+    True if instance image has the first part of middle horizontal line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('1_part_horizont_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('2_part_horizont_line')
+def _2_part_horizont_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -224,18 +349,27 @@ def has_2_part_horizont_line(instance, *, _show_area=False):
     }
 
     eps = (size[0] // 18, size[1] // 5)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_3_part_horizont_line(instance, *, _show_area=False):
+@register_feature
+def has_2_part_horizont_line(instance, *, _show_area=False, with_distance=False):
 
     """
-    True if instance image has the third part of middle horizontal line.
+    True if instance image has the second part of middle horizontal line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('2_part_horizont_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('3_part_horizont_line')
+def _3_part_horizont_line_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -243,32 +377,51 @@ def has_3_part_horizont_line(instance, *, _show_area=False):
     verifying_pixels = {(i, middle_y) for i in range(bbox[0] + bbox_size[0] * 7 // 10, bbox[2])}
 
     eps = (size[0] // 18, size[1] // 5)
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_A_slopping_lines(instance, *, _show_area=False):
+@register_feature
+def has_3_part_horizont_line(instance, *, _show_area=False, with_distance=False):
+
     """
-    True if instance image has A slopping lines
+    True if instance image has the third part of middle horizontal line.
     :param instance: recognition.Instance object
     :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('3_part_horizont_line', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('A_slopping_lines')
+def _A_slopping_lines_template(size):
     bbox = (size[0] // 6, size[1] // 10, size[0] * 5 // 6, size[1] * 5 // 6)
     verifying_pixels = set(get_A_slopping_lines_pixels(*bbox))
 
     eps = min(size) // 5
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_B_circles(instance, *, _show_area=False):
+@register_feature
+def has_A_slopping_lines(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has B circularities
+    True if instance image has A slopping lines
     :param instance: recognition.Instance object
-    :param _show_area: if True shows area of feature for instance 
+    :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('A_slopping_lines', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('B_circles')
+def _B_circles_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -283,17 +436,26 @@ def has_B_circles(instance, *, _show_area=False):
     verifying_pixels = upper_belly | bottom_belly
 
     eps = min(size) // 6
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_C_circle(instance, *, _show_area=False):
+@register_feature
+def has_B_circles(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has C circularity
+    True if instance image has B circularities
     :param instance: recognition.Instance object
-    :param _show_area: if True shows area of feature for instance
+    :param _show_area: if True shows area of feature for instance 
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('B_circles', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('C_circle')
+def _C_circle_template(size):
     bbox = (size[0] // 15, size[1] // 15, size[0] * 14 // 15, size[1] * 14 // 15)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -316,18 +478,26 @@ def has_C_circle(instance, *, _show_area=False):
     verifying_pixels -= bottom_optional_tail
 
     eps = min(size) // 5
+    return verifying_pixels, eps
 
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
 
-
-def has_D_belly(instance, *, _show_area=False):
+@register_feature
+def has_C_circle(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has D belly
+    True if instance image has C circularity
     :param instance: recognition.Instance object
-    :param _show_area: if True shows area of feature for instance 
+    :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('C_circle', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('D_belly')
+def _D_belly_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -335,17 +505,26 @@ def has_D_belly(instance, *, _show_area=False):
     verifying_pixels = {(x - bbox_size[0], y) for x, y in ellipse if x >= bbox[2]}
 
     eps = min(size) // 5
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
 
 
-def has_hook_from_J(instance, *, _show_area=False):
+@register_feature
+def has_D_belly(instance, *, _show_area=False, with_distance=False):
     """
-    True if instance image has a hook from J
+    True if instance image has D belly
     :param instance: recognition.Instance object
-    :param _show_area: if True shows area of feature for instance
+    :param _show_area: if True shows area of feature for instance 
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
     :return: True or False
     """
-    size = instance.size
+    verifying_pixels, eps = get_template('D_belly', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
+
+
+@register_template('hook_from_J')
+def _hook_from_J_template(size):
     bbox = (size[0] // 10, size[1] // 10, size[0] * 9 // 10, size[1] * 9 // 10)
     bbox_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
@@ -357,13 +536,107 @@ def has_hook_from_J(instance, *, _show_area=False):
     verifying_pixels = {p for p in ellipse if p[1] >= center_y}
 
     eps = [size[0] // 6, size[1] // 8]
-    return _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, _show_area=_show_area)
+    return verifying_pixels, eps
+
 
+@register_feature
+def has_hook_from_J(instance, *, _show_area=False, with_distance=False):
+    """
+    True if instance image has a hook from J
+    :param instance: recognition.Instance object
+    :param _show_area: if True shows area of feature for instance
+    :param with_distance: if True returns tuple of answer and the largest distance from verifying pixels to instance
+    :return: True or False
+    """
+    verifying_pixels, eps = get_template('hook_from_J', instance.size)
+    return _scale_feature_with_verifying_pixels(
+        instance, verifying_pixels, eps, _show_area=_show_area, with_distance=with_distance
+    )
 
-def _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, *, _show_area=False):
-    instance_pixels = set(instance.pixels)
+
+class DistanceMap:
+    """
+    Distances from each pixel of instance bounding box to the nearest instance pixel.
+    Made once for instance, it answers whether there are instance pixels in locality of a pixel in O(1).
+    """
+    def __init__(self, instance):
+        self.size = instance.size
+        self.pixels = np.argwhere(instance.bitmap)[:, ::-1].astype(np.int64)
+        self.row_distances = get_row_distances(instance.bitmap)
+        self._l1_distances = None
+        self._band_distances = dict()
+
+    @property
+    def l1_distances(self):
+        """
+        Distances to the nearest instance pixel in metric r = x + y, made on first access
+        :return: 2-D float array indexed as [y, x]
+        """
+        if self._l1_distances is None:
+            self._l1_distances = get_l1_distances(None, self.row_distances)
+        return self._l1_distances
+
+    def get_band_distances(self, half_height):
+        """
+        Horizontal distances to the nearest instance pixel in rows differing by no more than half_height
+        :param half_height: half height of rectangle locality
+        :return: 2-D float array indexed as [y, x]
+        """
+        if half_height not in self._band_distances:
+            self._band_distances[half_height] = get_band_distances(self.row_distances, half_height)
+        return self._band_distances[half_height]
+
+    def get_distances(self, pixels, area_size):
+        """
+        Find distances from pixels to the nearest instance pixel in metric of locality (see tools.get_locality).
+        For integer area_size it is distance in metric r = x + y.
+        For tuple area_size it is horizontal distance to instance pixels in band of rows of height 2*area_size[1].
+        So there are instance pixels in locality of pixel if its distance is not more than area_size (area_size[0]).
+        :param pixels: iterable of (x, y) tuples or int array with shape (pixels, 2)
+        :param area_size: integer or tuple value depending on type of locality
+        :return: float array of distances, inf if there are no instance pixels in the band
+        """
+        if not isinstance(pixels, np.ndarray):
+            pixels = list(pixels)
+        points = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+        is_rectangle = np.ndim(area_size) > 0
+        distance_map = self.get_band_distances(area_size[1]) if is_rectangle else self.l1_distances
+
+        inside = (points >= 0).all(axis=1) & (points < self.size).all(axis=1)
+        distances = np.empty(len(points))
+        distances[inside] = distance_map[points[inside, 1], points[inside, 0]]
+
+        for index in np.flatnonzero(~inside):
+            offsets = np.abs(self.pixels - points[index])
+            if is_rectangle:
+                offsets = offsets[offsets[:, 1] <= area_size[1], 0]
+            else:
+                offsets = offsets.sum(axis=1)
+            distances[index] = offsets.min() if len(offsets) else np.inf
+        return distances
+
+
+def get_distance_map(instance):
+    """
+    Get distance map of instance, it is made once and stored in instance
+    :param instance: recognition.Instance object
+    :return: DistanceMap object
+    """
+    distance_map = getattr(instance, 'distance_map', None)
+    if distance_map is None:
+        distance_map = instance.distance_map = DistanceMap(instance)
+    return distance_map
+
+
+def _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, *, _show_area=False, with_distance=False):
+    distances = get_distance_map(instance).get_distances(verifying_pixels, eps)
+    is_feature = bool((distances <= (eps[0] if np.ndim(eps) > 0 else eps)).all())
 
     if _show_area:
+        verifying_pixels = [tuple(p) for p in np.asarray(verifying_pixels).tolist()]
+        from PIL import ImageDraw
+
+        instance_pixels = set(instance.pixels)
         showing_img = Image.new('RGB', instance.size, WHITE)
         canvas = ImageDraw.ImageDraw(showing_img)
 
@@ -377,27 +650,265 @@ def _scale_feature_with_verifying_pixels(instance, verifying_pixels, eps, *, _sh
         for pixel in instance_pixels:
             canvas.point(pixel, GREEN)
 
-    for pixel in verifying_pixels:
-        if instance_pixels.isdisjoint(get_locality(pixel, eps)):
-            if _show_area:
+        for pixel in verifying_pixels:
+            if instance_pixels.isdisjoint(get_locality(pixel, eps)):
                 for locality_pixel in get_locality(pixel, eps):
                     canvas.point(locality_pixel, BLUE)
                 canvas.point(pixel, RED)
-                showing_img.show()
-            return False
-
-    if _show_area:
+                break
         showing_img.show()
-    return True
 
+    if with_distance:
+        return is_feature, float(distances.max()) if len(distances) else 0.
+    return is_feature
+
+
+_FEATURE_FUNCS_VIEW = MappingProxyType(FEATURE_FUNCS)
 
-def find_features(instance):
+
+def get_feature_funcs():
+    """
+    Get registered feature functions, see register_feature
+    :return: read-only dictionary with feature names as keys and functions as values
+    """
+    return _FEATURE_FUNCS_VIEW
+
+
+def find_features(instance, *, with_distance=False):
     """
     Scales all features for given instance
     :param instance: recognition.Instance object
+    :param with_distance: if True values are tuples of answer and the largest distance from verifying pixels
     :return: Dict with feature names as keys and boolean answers as values
     """
-    feature_funcs = {
-        key: value for key, value in globals().items() if key.startswith('has_')
-    }
-    return {func_name[4:]: func(instance) for func_name, func in feature_funcs.items()}
+    return {name: func(instance, with_distance=with_distance) for name, func in get_feature_funcs().items()}
+
+
+# maximal number of instances whose distance maps are made at once by find_features_batch
+FEATURE_BATCH_SIZE = 256
+
+
+def scale_template_features(bitmaps, feature_names, *, profile=None):
+    """
+    Scale features with templates for stack of instances of the same size at once.
+    Bitmaps are padded, so all verifying pixels are inside them, and distances from verifying pixels
+    are read from distance maps made for whole stack. Answers are the same as of
+    _scale_feature_with_verifying_pixels for each instance.
+    :param bitmaps: bool array with shape (instances, height, width) of instance bitmaps
+    :param feature_names: names of features with registered templates
+    :param profile: profiling.Profile object collecting feature times, or None
+    :return: tuple of bool array with shape (instances, features) of answers and float array of the same shape
+        with the largest distances from verifying pixels to instances
+    """
+    count, height, width = bitmaps.shape
+    values = np.empty((count, len(feature_names)), dtype=bool)
+    distances = np.zeros((count, len(feature_names)))
+    if not count:
+        return values, distances
+
+    templates = [get_template(name, (width, height)) for name in feature_names]
+    points = np.concatenate([np.zeros((1, 2), dtype=np.int64)] + [pixels for pixels, _ in templates])
+    left, top = np.maximum(0, -points.min(axis=0)).tolist()
+    right, bottom = np.maximum(0, points.max(axis=0) - (width - 1, height - 1)).tolist()
+    row_distances = get_row_distances(np.pad(bitmaps, ((0, 0), (top, bottom), (left, right))))
+
+    # band distances by half height of band and distances in metric r = x + y by None
+    distance_maps = dict()
+    for index, (name, (pixels, eps)) in enumerate(zip(feature_names, templates)):
+        with profile_stage(profile, f'feature.{name}'):
+            is_rectangle = np.ndim(eps) > 0
+            key = eps[1] if is_rectangle else None
+            if key not in distance_maps:
+                distance_maps[key] = get_band_distances(row_distances, key) if is_rectangle \
+                    else get_l1_distances(None, row_distances)
+
+            pixel_distances = distance_maps[key][:, pixels[:, 1] + top, pixels[:, 0] + left]
+            values[:, index] = (pixel_distances <= (eps[0] if is_rectangle else eps)).all(axis=1)
+            if len(pixels):
+                distances[:, index] = pixel_distances.max(axis=1)
+    return values, distances
+
+
+def find_features_batch(instances, *, with_distance=False, profile=None):
+    """
+    Scale all features for many instances at once. Instances are grouped by size and features with templates
+    are scaled for stacks of bitmaps by scale_template_features, other features are scaled by their functions.
+    :param instances: list of recognition.Instance objects
+    :param with_distance: if True distances from verifying pixels are returned too
+    :param profile: profiling.Profile object collecting feature times, or None
+    :return: bool array with shape (instances, features) of answers, features are in order of get_feature_funcs,
+        with with_distance tuple of it and float array of the largest distances from verifying pixels
+    """
+    feature_funcs = get_feature_funcs()
+    names = list(feature_funcs)
+    template_columns = [index for index, name in enumerate(names) if name in TEMPLATE_FUNCS]
+    values = np.zeros((len(instances), len(names)), dtype=bool)
+    distances = np.zeros((len(instances), len(names)))
+
+    groups = dict()
+    for index, instance in enumerate(instances):
+        groups.setdefault(instance.size, list()).append(index)
+    for indices in groups.values():
+        for start in range(0, len(indices), FEATURE_BATCH_SIZE):
+            rows = indices[start:start + FEATURE_BATCH_SIZE]
+            bitmaps = np.stack([instances[index].bitmap for index in rows])
+            rows_values, rows_distances = scale_template_features(
+                bitmaps, [names[column] for column in template_columns], profile=profile
+            )
+            values[np.ix_(rows, template_columns)] = rows_values
+            distances[np.ix_(rows, template_columns)] = rows_distances
+
+    for column in sorted(set(range(len(names))) - set(template_columns)):
+        func = feature_funcs[names[column]]
+        if profile is not None:
+            func = profile.wrap_features({names[column]: func})[names[column]]
+        for row, instance in enumerate(instances):
+            answer = func(instance, with_distance=with_distance)
+            values[row, column], distances[row, column] = answer if with_distance else (answer, 0.)
+
+    return (values, distances) if with_distance else values
+
+
+def get_feature_order(letters_determination=LETTERS_DETERMINATION):
+    """
+    Order features by how well they discriminate letters: features which split more pairs of letters go first
+    :param letters_determination: dictionary like LETTERS_DETERMINATION
+    :return: list of feature names used in letters_determination
+    """
+    votes = dict()
+    for letter_features in letters_determination.values():
+        for name, value in letter_features.items():
+            votes.setdefault(name, [0, 0])[value] += 1
+
+    return sorted(votes, key=lambda name: (-votes[name][0] * votes[name][1], -sum(votes[name]), name))
+
+
+class LazyFeatures(Mapping):
+    """
+    Features of instance, each of them is scaled on first access and remembered
+    """
+    def __init__(self, instance, feature_funcs=None):
+        self.instance = instance
+        self.feature_funcs = get_feature_funcs() if feature_funcs is None else feature_funcs
+        self.computed = dict()
+
+    def __getitem__(self, name):
+        if name not in self.computed:
+            self.computed[name] = self.feature_funcs[name](self.instance)
+        return self.computed[name]
+
+    def __iter__(self):
+        return iter(self.feature_funcs)
+
+    def __len__(self):
+        return len(self.feature_funcs)
+
+
+class LetterMatcher:
+    """
+    Letters determination compiled into bit masks.
+    Bit i of masks corresponds to feature feature_names[i], for each letter care mask has bits of its features
+    and value mask has bits of features which must be True.
+    """
+    def __init__(self, letters_determination=LETTERS_DETERMINATION, feature_order=None):
+        """
+        :param letters_determination: dictionary like LETTERS_DETERMINATION
+        :param feature_order: order of requesting features, by default given by get_feature_order
+        :raise ValueError: if some instance could match two letters
+        """
+        self.letters = list(letters_determination)
+        self.feature_names = list(get_feature_order(letters_determination) if feature_order is None
+                                  else feature_order)
+        feature_bits = {name: 1 << i for i, name in enumerate(self.feature_names)}
+
+        self.care_masks, self.value_masks = list(), list()
+        for letter_features in letters_determination.values():
+            self.care_masks.append(sum(feature_bits[name] for name in letter_features))
+            self.value_masks.append(sum(feature_bits[name] for name, value in letter_features.items() if value))
+
+        # the same masks as bool arrays with shape (letters, features) for match_matrix
+        self._care_matrix = np.array([[name in letter_features for name in self.feature_names]
+                                      for letter_features in letters_determination.values()], dtype=bool
+                                     ).reshape(len(self.letters), len(self.feature_names))
+        self._value_matrix = np.array([[letter_features.get(name, False) for name in self.feature_names]
+                                       for letter_features in letters_determination.values()], dtype=bool
+                                      ).reshape(len(self.letters), len(self.feature_names))
+
+        self._check_originality()
+
+    def _check_originality(self):
+        for i, j in combinations(range(len(self.letters)), 2):
+            both_care_mask = self.care_masks[i] & self.care_masks[j]
+            if not (self.value_masks[i] ^ self.value_masks[j]) & both_care_mask:
+                raise ValueError(
+                    f"'{self.letters[i]}' and '{self.letters[j]}' letters has similar both feature values"
+                )
+
+    def match_bits(self, value_bits):
+        """
+        Find letter for instance with all features known
+        :param value_bits: integer with bits of True features
+        :return: letter or None
+        """
+        for letter, care_mask, value_mask in zip(self.letters, self.care_masks, self.value_masks):
+            if (value_bits ^ value_mask) & care_mask == 0:
+                return letter
+        return None
+
+    def match(self, features):
+        """
+        Find the first letter whose features all match.
+        Features are requested in order of feature_names and only while they can change the answer,
+        so with LazyFeatures most features of an instance are never scaled.
+        :param features: mapping with feature names as keys and boolean answers as values
+        :return: letter or None
+        """
+        candidates = list(range(len(self.letters)))
+        known_bits = value_bits = 0
+
+        for bit, name in enumerate(self.feature_names):
+            if not candidates or self.care_masks[candidates[0]] & ~known_bits == 0:
+                break
+            feature_bit = 1 << bit
+            if not any(self.care_masks[i] & feature_bit for i in candidates):
+                continue
+
+            known_bits |= feature_bit
+            if features[name]:
+                value_bits |= feature_bit
+            candidates = [
+                i for i in candidates if (value_bits ^ self.value_masks[i]) & self.care_masks[i] & known_bits == 0
+            ]
+
+        return self.letters[candidates[0]] if candidates else None
+
+    def match_matrix(self, values, feature_names):
+        """
+        Find letters for many instances with all features known at once
+        :param values: bool array with shape (instances, features) of feature answers
+        :param feature_names: feature names of values columns, they include all feature_names of matcher
+        :return: list of letters or None for each instance
+        """
+        feature_names = list(feature_names)
+        values = np.asarray(values, dtype=bool).reshape(-1, len(feature_names))
+        values = values[:, [feature_names.index(name) for name in self.feature_names]]
+
+        matches = ~((values[:, None, :] ^ self._value_matrix) & self._care_matrix).any(axis=2)
+        first_matches = matches.argmax(axis=1).tolist()
+        return [self.letters[first] if is_matched else None
+                for first, is_matched in zip(first_matches, matches.any(axis=1).tolist())]
+
+
+LETTERS_MATCHER = LetterMatcher()
+
+
+def match_letter(features, letters_determination=LETTERS_DETERMINATION):
+    """
+    Find the first letter in letters_determination whose features all match, see LetterMatcher.match
+    :param features: mapping with feature names as keys and boolean answers as values
+    :param letters_determination: dictionary like LETTERS_DETERMINATION
+    :return: letter or None
+    """
+    matcher = LETTERS_MATCHER if letters_determination is LETTERS_DETERMINATION \
+        else LetterMatcher(letters_determination)
+    return matcher.match(features)
@@ -0,0 +1,196 @@
+import numpy as np
+
+from .recognition import Instance, Detection, get_parameters, get_cleaning_margin, clean_mask, open_image, \
+    find_thresholds, check_component_sizes, classify_batch
+from .tools import get_grayscale, get_histogram, binarize, label_components
+
+
+def _get_histogram_drift(histogram1, histogram2):
+    """
+    :return: share of pixels which should change brightness level to turn one histogram into another, from 0 to 1
+    """
+    return np.abs(histogram1 / histogram1.sum() - histogram2 / histogram2.sum()).sum() / 2
+
+
+def _get_changed_box(mask1, mask2):
+    """
+    :return: (x_min, y_min, x_max, y_max) box of pixels differing in masks, x_max and y_max are exclusive,
+        or None if masks are the same
+    """
+    changed = mask1 != mask2
+    rows, columns = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+    if not len(rows):
+        return None
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def _expand_box(box, margin, size):
+    return max(0, box[0] - margin), max(0, box[1] - margin), min(size[0], box[2] + margin), \
+        min(size[1], box[3] + margin)
+
+
+def _get_bitmap_key(bitmap):
+    return bitmap.shape, np.packbits(bitmap).tobytes()
+
+
+class FrameRecognizer:
+    """
+    Recognizer of consecutive frames of video, which reuses work done for previous frame:
+    threshold is kept until brightness histogram drifts, only region with changed black and white content is
+    cleaned and labeled again, and components with the same bitmaps as in previous frame are not classified again.
+    Detections are the same as recognize gives for each frame with threshold in use. Adaptive thresholds
+    follow local content, so with 'adaptive' threshold mode small max_histogram_drift is preferable.
+    """
+    def __init__(self, *, max_histogram_drift=0.02, with_features=False, **parameters):
+        """
+        :param max_histogram_drift: share of pixels changing brightness level, after which threshold is found again
+        :param with_features: if True detections have all features of letter instances
+        :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS, 'coarse_factor' is not used
+        """
+        self.parameters = get_parameters(**parameters)
+        self.max_histogram_drift = max_histogram_drift
+        self.with_features = with_features
+        self.stats = dict.fromkeys(
+            ('frames', 'threshold_updates', 'unchanged_frames', 'relabeled_pixels', 'classified', 'reused'), 0
+        )
+        self.reset()
+
+    def reset(self):
+        """
+        Forget previous frame, so the next one is processed from scratch
+        """
+        self._histogram = None
+        self._thresholds = None
+        self._binary = None
+        self._mask = None
+        # boxes (x_min, y_min, x_max, y_max with exclusive ends) of all components including filtered ones,
+        # instances of components or None for filtered ones, in order of their first pixels in rows scan
+        self._boxes = np.zeros((0, 4), dtype=np.int64)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._instances = list()
+
+    def _update_thresholds(self, grayscale):
+        histogram = get_histogram(grayscale)
+        if self._thresholds is None or np.shape(self._thresholds) not in ((), grayscale.shape) or \
+                _get_histogram_drift(histogram, self._histogram) > self.max_histogram_drift:
+            self._histogram = histogram
+            self._thresholds = find_thresholds(grayscale, **self.parameters)
+            self._binary = None
+            self.stats['threshold_updates'] += 1
+
+    def _find_relabeled_box(self, box):
+        """
+        Expand box of changed pixels, so all old components touching it are inside and new components
+        found in the box do not continue outside of it
+        :return: tuple of box and bool array of old components inside it
+        """
+        box = np.array(_expand_box(box, 1, self._mask.shape[::-1]))
+        inside = np.zeros(len(self._boxes), dtype=bool)
+        while True:
+            touching = ~inside & (self._boxes[:, 0] < box[2]) & (self._boxes[:, 2] > box[0]) & \
+                (self._boxes[:, 1] < box[3]) & (self._boxes[:, 3] > box[1])
+            if not touching.any():
+                return tuple(box.tolist()), inside
+            inside |= touching
+            box[:2] = np.minimum(box[:2], self._boxes[touching, :2].min(axis=0))
+            box[2:] = np.maximum(box[2:], self._boxes[touching, 2:].max(axis=0))
+
+    def _find_components(self, box):
+        """
+        :return: tuple of boxes, instances (None for filtered components) and scan order keys of components in box
+        """
+        labels, stats = label_components(self._mask[box[1]:box[3], box[0]:box[2]])
+        letter_sized, _ = check_component_sizes(
+            stats[:, 2] - stats[:, 0] + 1, stats[:, 3] - stats[:, 1] + 1, stats[:, 4], **self.parameters
+        )
+        boxes = stats[:, :4] + (box[0], box[1], box[0] + 1, box[1] + 1)
+        instances = [None] * len(stats)
+        for label in (np.flatnonzero(letter_sized) + 1).tolist():
+            x_min, y_min, x_max, y_max = stats[label - 1, :4].tolist()
+            bitmap = labels[y_min:y_max + 1, x_min:x_max + 1] == label
+            instances[label - 1] = Instance.from_bitmap(bitmap, (x_min + box[0], y_min + box[1]))
+
+        # the first pixel of component is the first one of its upper row
+        first_columns = [x_min + int(np.argmax(labels[y_min, x_min:x_max + 1] == label))
+                         for label, (x_min, y_min, x_max) in enumerate(stats[:, :3].tolist(), start=1)]
+        keys = (stats[:, 1] + box[1]) * self._mask.shape[1] + np.array(first_columns, dtype=np.int64) + box[0]
+        return boxes, instances, keys
+
+    def recognize(self, frame):
+        """
+        :param frame: image of any type accepted by recognition.open_image
+        :return: list of Detection objects
+        """
+        self.stats['frames'] += 1
+        grayscale = get_grayscale(open_image(frame))
+        if self._mask is not None and self._mask.shape != grayscale.shape:
+            self.reset()
+
+        self._update_thresholds(grayscale)
+        binary = binarize(grayscale, self._thresholds)
+        size = binary.shape[::-1]
+
+        if self._binary is None or self._mask is None:
+            self._mask = clean_mask(binary, **self.parameters)
+            box, relabeled = (0, 0, *size), np.ones(len(self._boxes), dtype=bool)
+        else:
+            changed_box = _get_changed_box(binary, self._binary)
+            if changed_box is None:
+                self.stats['unchanged_frames'] += 1
+                return self._get_detections()
+
+            # pixels of cleaned mask depend on binary pixels not farther than margin
+            margin = get_cleaning_margin(**self.parameters)
+            changed_box = _expand_box(changed_box, margin, size)
+            read_box = _expand_box(changed_box, margin, size)
+            cleaned = clean_mask(binary[read_box[1]:read_box[3], read_box[0]:read_box[2]], **self.parameters)
+            self._mask = self._mask.copy()
+            self._mask[changed_box[1]:changed_box[3], changed_box[0]:changed_box[2]] = cleaned[
+                changed_box[1] - read_box[1]:changed_box[3] - read_box[1],
+                changed_box[0] - read_box[0]:changed_box[2] - read_box[0]
+            ]
+            box, relabeled = self._find_relabeled_box(changed_box)
+        self._binary = binary
+        self.stats['relabeled_pixels'] += (box[2] - box[0]) * (box[3] - box[1])
+
+        previous = {_get_bitmap_key(instance.bitmap): instance
+                    for instance, is_relabeled in zip(self._instances, relabeled) if is_relabeled and instance}
+        boxes, instances, keys = self._find_components(box)
+        new_instances = list()
+        for instance in instances:
+            if instance is None:
+                continue
+            known = previous.get(_get_bitmap_key(instance.bitmap))
+            if known is not None and (known.features is not None or not self.with_features):
+                instance.letter, instance.features = known.letter, known.features
+                self.stats['reused'] += 1
+            else:
+                new_instances.append(instance)
+        classify_batch(new_instances, with_features=self.with_features, **self.parameters)
+        self.stats['classified'] += len(new_instances)
+
+        kept = np.flatnonzero(~relabeled)
+        all_keys = np.concatenate([self._keys[kept], keys])
+        order = np.argsort(all_keys, kind='stable')
+        all_instances = [self._instances[index] for index in kept.tolist()] + instances
+        self._boxes = np.concatenate([self._boxes[kept], boxes])[order]
+        self._keys = all_keys[order]
+        self._instances = [all_instances[index] for index in order.tolist()]
+        return self._get_detections()
+
+    def _get_detections(self):
+        return [Detection.from_instance(instance) for instance in self._instances if instance and instance.letter]
+
+
+def recognize_frames(frames, *, max_histogram_drift=0.02, with_features=False, **parameters):
+    """
+    Find letters on consecutive frames of video, see FrameRecognizer
+    :param frames: iterable of images of any type accepted by recognition.open_image
+    :param max_histogram_drift: share of pixels changing brightness level, after which threshold is found again
+    :param with_features: if True detections have all features of letter instances
+    :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS
+    :return: generator of lists of Detection objects, one list for each frame
+    """
+    recognizer = FrameRecognizer(max_histogram_drift=max_histogram_drift, with_features=with_features, **parameters)
+    for frame in frames:
+        yield recognizer.recognize(frame)
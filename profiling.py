@@ -0,0 +1,85 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+from time import perf_counter
+
+
+class Profile:
+    """
+    Collector of pipeline wall times and counters. Pass it as 'profile' argument of recognize or find_letters.
+    Stage times are named as stages ('open_image', 'grayscale', 'threshold', 'binarize', 'clean_mask',
+    'find_instances', 'classify', 'resize', 'annotate'), feature times are named 'feature.<feature name>'.
+    Counters are 'black_pixels', 'components', 'rejected', 'oversized', 'resized', 'matched',
+    'cache_hits' and 'cache_misses'.
+    """
+    def __init__(self, callback=None):
+        """
+        :param callback: function called as callback(kind, name, value) on each record, kind is 'time' or 'count',
+            for example to send numbers to metrics system right away
+        """
+        self.callback = callback
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self._lock = Lock()
+        self._feature_funcs = dict()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.times[name] += seconds
+            self.calls[name] += 1
+        if self.callback is not None:
+            self.callback('time', name, seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+        if self.callback is not None:
+            self.callback('count', name, value)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager adding wall time of its body to stage time
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def wrap_features(self, feature_funcs):
+        """
+        :param feature_funcs: dictionary of feature names and functions
+        :return: dictionary of the same functions recording their wall time
+        """
+        key = tuple(feature_funcs.items())
+        if key not in self._feature_funcs:
+            self._feature_funcs[key] = {name: self._timed(f'feature.{name}', func)
+                                        for name, func in feature_funcs.items()}
+        return self._feature_funcs[key]
+
+    def _timed(self, name, func):
+        def timed_func(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(name, perf_counter() - start)
+        return timed_func
+
+    def to_dict(self):
+        """
+        :return: dictionary with 'times' (seconds), 'calls' and 'counters' dictionaries
+        """
+        with self._lock:
+            return {'times': dict(self.times), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+
+def profile_stage(profile, name):
+    """
+    :param profile: Profile object or None
+    :param name: stage name
+    :return: context manager timing stage, it does nothing if profile is None
+    """
+    return nullcontext() if profile is None else profile.stage(name)
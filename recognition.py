@@ -1,95 +1,470 @@
+import io
 import os
+from functools import lru_cache
 
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image
 
-from .features import find_features, LETTERS_DETERMINATION
-from .tools import WHITE, BLACK, PINK, get_neighbours, get_pixels_with_color, find_brightness_threshold, \
-    get_brightness, expand_black_areas, get_package_dir_path
+from .features import LazyFeatures, LETTERS_MATCHER, match_letter, get_feature_funcs, find_features_batch
+from .profiling import profile_stage
+from .tools import BLACK, PINK, find_brightness_threshold, find_image_threshold, get_grayscale, binarize, \
+    dilate, opening, mask_to_image, label_components, get_package_dir_path, find_block_thresholds, \
+    interpolate_thresholds, get_structuring_element, fill_runs, RunLengthImage, to_uint8
+
+
+DEFAULT_PARAMETERS = {
+    # 'global' - one Otsu threshold for whole image,
+    # 'adaptive' - Otsu thresholds of square blocks interpolated between block centers
+    'threshold_mode': 'global',
+    'threshold_block_size': 64,
+    # blocks with smaller brightness difference between ink and paper are considered as blank paper
+    'threshold_min_contrast': 32,
+    # black specks smaller than opening structuring element are removed, 0 turns it off
+    'opening_size': 0,
+    'opening_shape': 'square',
+    # black areas are expanded to join broken strokes, see tools.get_structuring_element for sizes and shapes
+    'dilation_size': 3,
+    'dilation_shape': 'square',
+    'dilation_iterations': 1,
+    # if True black and white image is cleaned and labeled as runs of black pixels, see tools.RunLengthImage,
+    # so time and memory of these stages depend on amount of ink rather than on image area
+    'run_length': False,
+    # (width, height) of grid all instances are resampled to before feature scaling, for example (50, 70),
+    # so feature templates are made only once. None keeps instance proportions
+    'canonical_grid': None,
+    # if more than 1, instances are searched on image reduced by this factor (with JPEG draft mode when possible)
+    # and only their boxes are taken from full resolution image for classification
+    'coarse_factor': 1,
+    # components which can not be letters are dropped while they are found, before any per-pixel work:
+    # smaller side or pixel count under minimum, or height to width ratio outside of (min_aspect, max_aspect)
+    'min_component_size': 10,
+    'min_component_area': 0,
+    'min_aspect': 0.3,
+    'max_aspect': 5,
+    # bigger components, like page borders or shadows, are dropped as oversized, None turns limit off
+    'max_component_size': None,
+    'max_component_area': None,
+}
+
+
+def get_parameters(**parameters):
+    """
+    Complete pipeline parameters with default values
+    :param parameters: parameters to override, names are keys of DEFAULT_PARAMETERS
+    :return: dictionary with all pipeline parameters
+    """
+    unknown = parameters.keys() - DEFAULT_PARAMETERS.keys()
+    if unknown:
+        raise TypeError(f"unknown pipeline parameters: {', '.join(sorted(unknown))}")
+    return {**DEFAULT_PARAMETERS, **parameters}
+
+
+def check_component_sizes(widths, heights, areas, **parameters):
+    """
+    Apply component size, area and aspect filters of pipeline parameters
+    :param widths: array of component widths
+    :param heights: array of component heights
+    :param areas: array of component pixel counts
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: (letter_sized, oversized) bool arrays, components of neither of them are too small or of wrong aspect
+    """
+    parameters = get_parameters(**parameters)
+    widths, heights, areas = np.asarray(widths), np.asarray(heights), np.asarray(areas)
+
+    oversized = np.zeros(widths.shape, dtype=bool)
+    if parameters['max_component_size'] is not None:
+        oversized |= np.maximum(widths, heights) > parameters['max_component_size']
+    if parameters['max_component_area'] is not None:
+        oversized |= areas > parameters['max_component_area']
+
+    aspects = heights / widths
+    letter_sized = (np.minimum(widths, heights) >= parameters['min_component_size']) & \
+        (areas >= parameters['min_component_area']) & \
+        (parameters['min_aspect'] < aspects) & (aspects < parameters['max_aspect']) & ~oversized
+    return letter_sized, oversized
+
+
+def is_letter_size(size, area=None, **parameters):
+    """
+    :param size: (width, height) of instance
+    :param area: number of instance pixels, if None it is not checked
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: True if instance passes filters of check_component_sizes
+    """
+    if area is None:
+        parameters = {**parameters, 'min_component_area': 0, 'max_component_area': None}
+        area = 0
+    letter_sized, _ = check_component_sizes([size[0]], [size[1]], [area], **parameters)
+    return bool(letter_sized[0])
+
+
+def count_filtered(profile, letter_sized, oversized):
+    """
+    Add counters of components dropped by check_component_sizes to profile
+    """
+    if profile is not None:
+        profile.count('oversized', int(np.count_nonzero(oversized)))
+        profile.count('rejected', int(np.count_nonzero(~letter_sized & ~oversized)))
 
 
 class Instance:
-    def __init__(self, pixels):
-        x_vals, y_vals = [set(vals) for vals in zip(*pixels)]
-        min_x, max_x = min(x_vals), max(x_vals)
-        min_y, max_y = min(y_vals), max(y_vals)
+    """
+    Connected black component of image. It is stored as bool bitmap of its bounding box indexed as [y, x],
+    True for component pixels; start_pix is (x, y) of bounding box left upper corner on image.
+    """
+    __slots__ = ('bitmap', 'start_pix', 'distance_map', 'letter', 'features')
 
-        self.start_pix = min_x, min_y
-        self.pixels = [(x - min_x, y - min_y) for x, y in pixels]
-        self.size = (max_x - min_x + 1, max_y - min_y + 1)
+    def __init__(self, pixels, size=None):
+        """
+        :param pixels: iterable of (x, y) tuples of instance pixels
+        :param size: if given, pixels are placed in box of this size with left upper corner at (0, 0),
+            otherwise box is bounding box of pixels
+        """
+        if not isinstance(pixels, np.ndarray):
+            pixels = list(pixels)
+        points = np.asarray(pixels, dtype=np.intp).reshape(-1, 2)
+
+        if size is None:
+            min_x, min_y = points.min(axis=0).tolist()
+            max_x, max_y = points.max(axis=0).tolist()
+            size = (max_x - min_x + 1, max_y - min_y + 1)
+        else:
+            min_x, min_y = 0, 0
+
+        bitmap = np.zeros((size[1], size[0]), dtype=bool)
+        bitmap[points[:, 1] - min_y, points[:, 0] - min_x] = True
+        self._set_bitmap(bitmap, (min_x, min_y))
+
+    @classmethod
+    def from_bitmap(cls, bitmap, start_pix=(0, 0)):
+        """
+        :param bitmap: 2-D bool array of instance bounding box indexed as [y, x], it is not copied
+        :param start_pix: (x, y) of bitmap left upper corner on image
+        :return: Instance object
+        """
+        instance = cls.__new__(cls)
+        instance._set_bitmap(bitmap, start_pix)
+        return instance
+
+    def _set_bitmap(self, bitmap, start_pix):
+        self.bitmap = bitmap
+        self.start_pix = tuple(start_pix)
+        self.distance_map = None
+        self.letter = None
+        self.features = None
+
+    @property
+    def size(self):
+        return self.bitmap.shape[1], self.bitmap.shape[0]
+
+    @property
+    def pixels(self):
+        """
+        :return: list of (x, y) tuples of instance pixels relative to start_pix
+        """
+        y_vals, x_vals = np.nonzero(self.bitmap)
+        return list(zip(x_vals.tolist(), y_vals.tolist()))
+
+    def _get_resampled_bitmap(self, size):
+        image = Image.fromarray(np.where(self.bitmap, 0, 255).astype(np.uint8), 'L')
+        return np.asarray(image.resize(tuple(size))) < 130
 
     def get_resized(self, ratio):
-        resized_img = Image.new('RGB', self.size, WHITE)
-        for pixel in self.pixels:
-            resized_img.putpixel(pixel, BLACK)
+        bitmap = self._get_resampled_bitmap([int(s * ratio) for s in self.size])
+        rows, columns = np.flatnonzero(bitmap.any(axis=1)), np.flatnonzero(bitmap.any(axis=0))
+        if not len(rows):
+            return Instance.from_bitmap(bitmap)
+        return Instance.from_bitmap(bitmap[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1],
+                                    (int(columns[0]), int(rows[0])))
 
-        resized_img = resized_img.resize([int(s * ratio) for s in self.size])
-        brightness = get_brightness(resized_img)
-        resized_pixels = {pixel for pixel, bright in brightness.items() if bright < 130}
-        return Instance(resized_pixels)
+    def get_normalized(self, grid):
+        """
+        Resample instance to canonical grid, so its size is exactly grid size
+        :param grid: (width, height) of canonical grid
+        :return: new Instance object
+        """
+        return Instance.from_bitmap(self._get_resampled_bitmap(grid))
 
-    def classify(self):
+    def _get_scaled_instance(self, parameters, profile=None):
+        """
+        :param parameters: complete pipeline parameters
+        :param profile: profiling.Profile object collecting times and counters, or None
+        :return: instance whose features are scaled, it is self or its resized or normalized copy,
+            or None if instance is not letter sized
+        """
+        size = self.size
+        if not is_letter_size(size, int(np.count_nonzero(self.bitmap)), **parameters):
+            if profile is not None:
+                profile.count('rejected')
+            return None
+
+        canonical_grid = parameters['canonical_grid']
+        ratio = 70 / max(size)
+        if not canonical_grid and ratio >= 1:
+            return self
+        with profile_stage(profile, 'resize'):
+            normalized = self.get_normalized(canonical_grid) if canonical_grid else self.get_resized(ratio)
+        if profile is not None:
+            profile.count('resized')
+        return normalized
+
+    def classify(self, *, with_features=False, profile=None, **parameters):
         """
         If instance is similar to one of defined letters, makes an attribute 'letter', which is string representation 
         of that letter. Else attribute 'letter' takes a value None
         :param self: Instance object
+        :param with_features: if True makes an attribute 'features' with all features of instance, else it is None
+        :param profile: profiling.Profile object collecting times and counters, or None
+        :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
         :return: None
         """
-        size = self.size
-        if min(size) < 10 or not 0.3 < size[1]/size[0] < 5:
+        self.features = None
+        normalized = self._get_scaled_instance(get_parameters(**parameters), profile)
+        if normalized is None:
             self.letter = None
             return
 
-        ratio = 70 / max(size)
-        instance_features = find_features(self.get_resized(ratio)) if ratio < 1 else find_features(self)
+        if profile is None:
+            features = LazyFeatures(normalized)
+        else:
+            features = LazyFeatures(normalized, profile.wrap_features(get_feature_funcs()))
+        self.letter = match_letter(features)
+        if profile is not None and self.letter:
+            profile.count('matched')
+        if with_features:
+            self.features = dict(features)
 
-        for letter, letter_features in LETTERS_DETERMINATION.items():
-            if set(letter_features.items()).issubset(instance_features.items()):
-                self.letter = letter
-                return
-        self.letter = None
+
+class Detection:
+    """
+    Lightweight record of found letter
+    """
+    __slots__ = ('letter', 'start_pix', 'bbox', 'features')
+
+    def __init__(self, letter, start_pix, size, features=None):
+        """
+        :param letter: string representation of letter
+        :param start_pix: (x, y) of left upper pixel of letter
+        :param size: (width, height) of letter
+        :param features: optional dictionary with feature names as keys and boolean answers as values
+        """
+        self.letter = letter
+        self.start_pix = tuple(start_pix)
+        self.bbox = (start_pix[0], start_pix[1], start_pix[0] + size[0], start_pix[1] + size[1])
+        self.features = features
+
+    @classmethod
+    def from_instance(cls, instance):
+        return cls(instance.letter, instance.start_pix, instance.size, getattr(instance, 'features', None))
+
+    @property
+    def size(self):
+        return self.bbox[2] - self.bbox[0], self.bbox[3] - self.bbox[1]
+
+    def to_dict(self):
+        """
+        :return: dictionary with JSON serializable values
+        """
+        detection = {'letter': self.letter, 'bbox': list(self.bbox), 'start_pix': list(self.start_pix)}
+        if self.features is not None:
+            detection['features'] = dict(self.features)
+        return detection
+
+    def __eq__(self, other):
+        return isinstance(other, Detection) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"Detection({self.letter!r}, bbox={self.bbox})"
+
+
+def find_thresholds(grayscale, **parameters):
+    """
+    Find brightness threshold according to 'threshold_mode' parameter
+    :param grayscale: 2-D array of brightness levels
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: threshold value or 2-D array with threshold value for each pixel
+    """
+    parameters = get_parameters(**parameters)
+    mode = parameters['threshold_mode']
+
+    if mode == 'global':
+        return find_brightness_threshold(grayscale)
+    if mode == 'adaptive':
+        block_size = parameters['threshold_block_size']
+        block_thresholds = find_block_thresholds(grayscale, block_size, parameters['threshold_min_contrast'])
+        return interpolate_thresholds(block_thresholds, grayscale.shape, block_size)
+    raise ValueError(f"unknown threshold mode: '{mode}'")
+
+
+def binarize_image(image, *, profile=None, **parameters):
+    """
+    Make basic filtration without leaving array form: turning colors into black and white, removing noise.
+    :param image: PIL.Image.Image object or numpy.ndarray, see tools.get_grayscale
+    :param profile: profiling.Profile object collecting times and counters, or None
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: 2-D bool numpy.ndarray indexed as [y, x], True for black pixels,
+        or tools.RunLengthImage object if 'run_length' parameter is True
+    """
+    parameters = get_parameters(**parameters)
+    with profile_stage(profile, 'grayscale'):
+        grayscale = get_grayscale(image)
+    with profile_stage(profile, 'threshold'):
+        thresh_value = find_thresholds(grayscale, **parameters)
+    with profile_stage(profile, 'binarize'):
+        mask = binarize(grayscale, thresh_value)
+        if parameters['run_length']:
+            mask = RunLengthImage.from_mask(mask)
+    if profile is not None:
+        profile.count('black_pixels', mask.area if parameters['run_length'] else int(np.count_nonzero(mask)))
+    with profile_stage(profile, 'clean_mask'):
+        return clean_mask(mask, **parameters)
+
+
+def clean_mask(mask, **parameters):
+    """
+    Remove noise from binary image and expand its black areas
+    :param mask: 2-D bool array, True for black pixels, or tools.RunLengthImage object
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: new 2-D bool array or RunLengthImage object
+    """
+    parameters = get_parameters(**parameters)
+    if isinstance(mask, RunLengthImage):
+        if parameters['opening_size']:
+            mask = mask.opening(parameters['opening_size'], parameters['opening_shape'])
+        return mask.dilate(parameters['dilation_size'], parameters['dilation_shape'], parameters['dilation_iterations'])
+
+    if parameters['opening_size']:
+        mask = opening(mask, parameters['opening_size'], parameters['opening_shape'])
+    return dilate(
+        mask, parameters['dilation_size'], parameters['dilation_shape'], parameters['dilation_iterations']
+    )
+
+
+def get_cleaning_margin(**parameters):
+    """
+    Find how many rows around a pixel can affect it in clean_mask
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: number of rows
+    """
+    parameters = get_parameters(**parameters)
+    margin = get_structuring_element(parameters['dilation_size'], parameters['dilation_shape']).shape[0] * \
+        parameters['dilation_iterations']
+    if parameters['opening_size']:
+        margin += 2 * get_structuring_element(parameters['opening_size'], parameters['opening_shape']).shape[0]
+    return margin
 
 
-def handle_image(image):
+def handle_image(image, **parameters):
     """
     Make basic filtration: removing noise from image, turning colors into black and white.
     :param image: PIL.Image.Image object
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
     :return: PIL.Image.Image object
     """
-    filtered_image = Image.new('RGB', image.size, WHITE)
-    pixels = filtered_image.load()
+    mask = binarize_image(image, **parameters)
+    return mask_to_image(mask.to_mask() if isinstance(mask, RunLengthImage) else mask)
 
-    brightness = get_brightness(image)
-    thresh_value = find_brightness_threshold(brightness)
-    for (i, j), bright in brightness.items():
-        pixels[i, j] = WHITE if bright > thresh_value else BLACK
 
-    filtered_image = expand_black_areas(filtered_image)
-    return filtered_image
+def find_instances(img, *, profile=None, **parameters):
+    """
+    Find instances on the image. Components dropped by size, area and aspect filters of parameters
+    do not become instances.
+    :param img: PIL.Image.Image object, binary array or tools.RunLengthImage object made by binarize_image
+    :param profile: profiling.Profile object collecting counters, or None
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: list of Instance objects
+    """
+    if isinstance(img, RunLengthImage):
+        return _find_run_instances(img, profile, parameters)
+    if not isinstance(img, np.ndarray):
+        img = (np.asarray(img.convert('RGB')) == BLACK).all(axis=-1)
 
+    labels, stats = label_components(img)
+    letter_sized, oversized = check_component_sizes(
+        stats[:, 2] - stats[:, 0] + 1, stats[:, 3] - stats[:, 1] + 1, stats[:, 4], **parameters
+    )
+    if profile is not None:
+        profile.count('components', len(stats))
+        count_filtered(profile, letter_sized, oversized)
 
-def find_instances(img):
+    instances = list()
+    for label in (np.flatnonzero(letter_sized) + 1).tolist():
+        x_min, y_min, x_max, y_max, _ = stats[label - 1].tolist()
+        instances.append(Instance.from_bitmap(labels[y_min:y_max + 1, x_min:x_max + 1] == label, (x_min, y_min)))
+
+    return instances
+
+
+def _find_run_instances(runs, profile, parameters):
     """
-    Find instances on the image
-    :param img: PIL.Image.Image object
-    :return: list of Instance objects
+    find_instances for tools.RunLengthImage object, bitmaps of instances are filled from their runs
     """
-    black_pixels = set(get_pixels_with_color(img, BLACK))
+    components, stats = runs.label()
+    letter_sized, oversized = check_component_sizes(
+        stats[:, 2] - stats[:, 0] + 1, stats[:, 3] - stats[:, 1] + 1, stats[:, 4], **parameters
+    )
+    if profile is not None:
+        profile.count('components', len(stats))
+        count_filtered(profile, letter_sized, oversized)
+
+    # runs of each component are together after stable sort, in order of rows
+    order = np.argsort(components, kind='stable')
+    bounds = np.searchsorted(components[order], np.arange(len(stats) + 1)).tolist()
     instances = list()
+    for index in np.flatnonzero(letter_sized).tolist():
+        x_min, y_min, x_max, y_max, _ = stats[index].tolist()
+        component_runs = order[bounds[index]:bounds[index + 1]]
+        bitmap = fill_runs(np.zeros((y_max - y_min + 1, x_max - x_min + 1), dtype=bool),
+                           runs.rows[component_runs] - y_min, runs.starts[component_runs] - x_min,
+                           runs.ends[component_runs] - x_min)
+        instances.append(Instance.from_bitmap(bitmap, (x_min, y_min)))
+    return instances
 
-    while black_pixels:
-        object_pixels = set()
-        next_pixels = {black_pixels.pop(), }
 
-        while next_pixels:
-            black_pixels -= next_pixels
-            object_pixels.update(next_pixels)
+@lru_cache(maxsize=1)
+def get_font_data():
+    """
+    Read bundled font file once
+    :return: bytes of OpenSans-Regular.ttf
+    """
+    font_path = os.sep.join([get_package_dir_path(), 'OpenSans-Regular.ttf'])
+    with open(font_path, 'rb') as font_file:
+        return font_file.read()
 
-            next_pixels = set().union(*[get_neighbours(p) for p in next_pixels])
-            next_pixels &= black_pixels
 
-        instances.append(Instance(object_pixels))
+@lru_cache(maxsize=16)
+def get_font(size):
+    """
+    Get bundled font of given size, fonts are parsed once for each size
+    :param size: font size
+    :return: PIL.ImageFont.FreeTypeFont object
+    """
+    from PIL import ImageFont
 
-    return instances
+    return ImageFont.truetype(io.BytesIO(get_font_data()), size=size)
+
+
+def annotate(img, detections):
+    """
+    Creates a new image with marked detections
+    :param img: Original PIL.Image.Image image
+    :param detections: iterable of Detection objects
+    :return: New PIL.Image.Image object
+    """
+    from PIL import ImageDraw
+
+    output_img = img.convert('RGB') if img.mode in ('1', 'L', 'I', 'F') else img.copy()
+    draw = ImageDraw.Draw(output_img)
+    font = get_font(min(img.size) // 15)
+
+    for detection in detections:
+        start_pix, end_pix = detection.bbox[:2], detection.bbox[2:]
+        draw.rectangle((start_pix, end_pix), width=2, outline=PINK)
+        draw.text(end_pix, detection.letter, fill=PINK, font=font)
+
+    return output_img
 
 
 def create_output_image(img, instances):
@@ -99,29 +474,366 @@ def create_output_image(img, instances):
     :param instances: List of classified instances
     :return: New PIL.Image.Image object
     """
-    output_img = img.copy()
-    draw = ImageDraw.Draw(output_img)
+    return annotate(img, [Detection.from_instance(instance) for instance in instances if instance.letter])
 
-    font_path = os.sep.join([get_package_dir_path(), 'OpenSans-Regular.ttf'])
-    font = ImageFont.truetype(font_path, size=min(img.size) // 15)
 
+def _is_array(image):
+    return isinstance(image, (np.ndarray, memoryview)) or \
+        hasattr(image, '__array_interface__') and not isinstance(image, Image.Image)
+
+
+def open_image(image):
+    """
+    :param image: path to image, open binary file, bytes of image file, PIL.Image.Image object or array-like
+        object (numpy array, numpy.memmap, memoryview) of pixels indexed as [y, x]: 2-D for grayscale image,
+        3-D with 3 or 4 channels for RGB(A) image
+    :return: PIL.Image.Image object, or numpy.ndarray sharing memory with array-like image
+    """
+    if isinstance(image, Image.Image):
+        return image
+    if _is_array(image):
+        array = np.asarray(image)
+        return array[..., 0] if array.ndim == 3 and array.shape[2] == 1 else array
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    return Image.open(image)
+
+
+def open_raw_frame(path, shape, dtype=np.uint8, offset=0):
+    """
+    Map raw frame file into memory without reading it
+    :param path: path to file with pixels in row-major order and without header
+    :param shape: (height, width) of grayscale frame or (height, width, channels) of RGB(A) one
+    :param dtype: type of pixel values, values are scaled to 8 bits from the whole range of integer type
+        or from 0 to 1 for float type
+    :param offset: number of bytes before the first pixel
+    :return: read-only numpy.memmap, it can be passed to recognize and find_letters
+    """
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+
+
+def as_pil_image(img):
+    """
+    :param img: PIL.Image.Image object or numpy.ndarray given by open_image
+    :return: PIL.Image.Image object, contiguous uint8 arrays are wrapped without copying,
+        arrays of other types are scaled to uint8 (see tools.to_uint8)
+    """
+    if isinstance(img, Image.Image):
+        return img
+    img = to_uint8(img)
+    mode = 'L' if img.ndim == 2 else {3: 'RGB', 4: 'RGBA'}.get(img.shape[2])
+    if mode and img.dtype == np.uint8 and img.flags.c_contiguous:
+        return Image.frombuffer(mode, (img.shape[1], img.shape[0]), img, 'raw', mode, 0, 1)
+    return Image.fromarray(img)
+
+
+def get_image_size(img):
+    """
+    :param img: PIL.Image.Image object or numpy.ndarray given by open_image
+    :return: (width, height) of image
+    """
+    return img.size if isinstance(img, Image.Image) else (img.shape[1], img.shape[0])
+
+
+def _get_reopenable(image):
+    """
+    Open files can be read only once, so they are replaced by their content
+    """
+    return image.read() if hasattr(image, 'read') else image
+
+
+def open_coarse_image(image, factor):
+    """
+    Open image reduced by factor. JPEG files are decoded right in reduced size.
+    :param image: path to image, bytes of image file, PIL.Image.Image object or array-like object
+    :param factor: reduction factor
+    :return: PIL.Image.Image object
+    """
+    img = as_pil_image(open_image(image))
+    size = tuple(max(1, s // factor) for s in img.size)
+    if not isinstance(image, Image.Image) and img.format == 'JPEG':
+        draft = img.draft('L', size)
+        if draft is not None:
+            # draft reduces by power of 2 with rounding up, so the rest of reduction is done by resizing
+            # the part of drafted image which shows the original one
+            return img if img.size == size else img.resize(size, Image.Resampling.BOX, box=draft[1])
+    if img.mode not in ('L', 'RGB', 'RGBA', 'CMYK'):
+        # reduce can not average palette, bilevel and 16-bit pixels, brightness is the same as get_grayscale gives
+        img = img.convert('L')
+    return img.reduce(factor)
+
+
+def find_instances_coarse_to_fine(image, **parameters):
+    """
+    Find instances on image reduced by 'coarse_factor' parameter, then find them again in their boxes of
+    full resolution image. Only pixels near found components are labeled and classified in full resolution.
+    With 'global' threshold mode crops are thresholded by Otsu threshold of whole full resolution image,
+    see tools.find_image_threshold.
+    With 'adaptive' mode each crop is thresholded by its own Otsu threshold, so 'threshold_block_size'
+    and 'threshold_min_contrast' are used only for reduced image.
+    :param image: path to image, bytes of image file, PIL.Image.Image object or array-like object
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: list of Instance objects with full resolution coordinates
+    """
+    parameters = get_parameters(**parameters)
+    full_img = as_pil_image(open_image(image))
+    coarse_img = open_coarse_image(image, parameters['coarse_factor'])
+    x_scale, y_scale = (full_size / coarse_size for full_size, coarse_size in zip(full_img.size, coarse_img.size))
+
+    coarse_grayscale = get_grayscale(coarse_img)
+    # averaging of reduced image shifts its histogram, so threshold of crops is found for full resolution pixels,
+    # they are counted by PIL, only crops are turned into arrays
+    global_thresh = find_image_threshold(full_img) if parameters['threshold_mode'] == 'global' else None
+    coarse_mask = clean_mask(binarize(coarse_grayscale, find_thresholds(coarse_grayscale, **parameters)),
+                             **parameters)
+    _, stats = label_components(coarse_mask)
+    # coarse boxes are only approximate, so only oversized components are dropped before full resolution
+    _, coarse_oversized = check_component_sizes(
+        (stats[:, 2] - stats[:, 0] + 1) * x_scale, (stats[:, 3] - stats[:, 1] + 1) * y_scale,
+        stats[:, 4] * x_scale * y_scale, **parameters
+    )
+    stats = stats[~coarse_oversized]
+
+    margin = get_cleaning_margin(**parameters) + int(max(x_scale, y_scale)) + 1
+    found_boxes = set()
+    instances = list()
+
+    for x_min, y_min, x_max, y_max, _ in stats.tolist():
+        # box of coarse component in full resolution
+        core = (int(x_min * x_scale), int(y_min * y_scale), int((x_max + 1) * x_scale), int((y_max + 1) * y_scale))
+        if min(core[2] - core[0], core[3] - core[1]) < parameters['min_component_size']:
+            continue
+
+        crop_box = (max(0, core[0] - margin), max(0, core[1] - margin),
+                    min(full_img.size[0], core[2] + margin), min(full_img.size[1], core[3] + margin))
+        grayscale = get_grayscale(full_img.crop(crop_box))
+        thresh_value = find_brightness_threshold(grayscale) if global_thresh is None else global_thresh
+        labels, crop_stats = label_components(clean_mask(binarize(grayscale, thresh_value), **parameters))
+        letter_sized, _ = check_component_sizes(crop_stats[:, 2] - crop_stats[:, 0] + 1,
+                                                crop_stats[:, 3] - crop_stats[:, 1] + 1, crop_stats[:, 4],
+                                                **parameters)
+
+        for label, (crop_x_min, crop_y_min, crop_x_max, crop_y_max, area) in enumerate(crop_stats.tolist(), 1):
+            if not letter_sized[label - 1]:
+                continue
+            box = (crop_x_min + crop_box[0], crop_y_min + crop_box[1], crop_x_max + crop_box[0],
+                   crop_y_max + crop_box[1])
+            center = ((box[0] + box[2]) // 2, (box[1] + box[3]) // 2)
+            if not (core[0] <= center[0] < core[2] and core[1] <= center[1] < core[3]) or box in found_boxes:
+                continue
+            found_boxes.add(box)
+
+            bitmap = labels[crop_y_min:crop_y_max + 1, crop_x_min:crop_x_max + 1] == label
+            instances.append(Instance.from_bitmap(bitmap, box[:2]))
+
+    return instances
+
+
+def classify_batch(instances, *, with_features=False, profile=None, **parameters):
+    """
+    Classify instances with features scaled for all of them at once by features.find_features_batch,
+    so there is no overhead of scaling features instance by instance.
+    Results are the same as of Instance.classify for each instance.
+    :param instances: list of Instance objects
+    :param with_features: if True instances get all their features
+    :param profile: profiling.Profile object collecting times and counters, or None
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: None
+    """
+    parameters = get_parameters(**parameters)
+    classified, scaled = list(), list()
     for instance in instances:
-        if instance.letter:
-            size = instance.size
-            start_pix = instance.start_pix
-            end_pix = (start_pix[0] + size[0], start_pix[1] + size[1])
+        instance.letter = instance.features = None
+        scaled_instance = instance._get_scaled_instance(parameters, profile)
+        if scaled_instance is not None:
+            classified.append(instance)
+            scaled.append(scaled_instance)
+    if not scaled:
+        return
 
-            draw.rectangle((start_pix, end_pix), width=2, outline=PINK)
-            draw.text(end_pix, instance.letter, fill=PINK, font=font)
+    feature_names = list(get_feature_funcs())
+    values = find_features_batch(scaled, profile=profile)
+    letters = LETTERS_MATCHER.match_matrix(values, feature_names)
+    for instance, letter, instance_values in zip(classified, letters, values.tolist()):
+        instance.letter = letter
+        if with_features:
+            instance.features = dict(zip(feature_names, instance_values))
+    if profile is not None:
+        profile.count('matched', sum(1 for letter in letters if letter))
+
+
+def _attach_shared_memory(name):
+    """
+    Attach existing shared memory block without making the process responsible for its removal
+    """
+    from multiprocessing import get_start_method, resource_tracker, shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name)
+        # forked workers share resource tracker with parent, others would remove block at exit
+        if get_start_method(allow_none=True) != 'fork':
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
 
-    return output_img
+
+def _classify_shared(memory_name, entries, with_features, parameters):
+    """
+    Classify instances whose bitmaps are packed in shared memory
+    :param memory_name: name of shared memory block
+    :param entries: list of (offset, width, height) of instance bitmaps in block
+    :param with_features: if True features of instances are returned too
+    :param parameters: pipeline parameters
+    :return: list of (letter, features) tuples
+    """
+    memory = _attach_shared_memory(memory_name)
+    try:
+        instances = list()
+        for offset, width, height in entries:
+            bitmap = np.ndarray((height, width), dtype=bool, buffer=memory.buf, offset=offset)
+            instances.append(Instance.from_bitmap(bitmap.copy()))
+            del bitmap
+        classify_batch(instances, with_features=with_features, **parameters)
+        return [(instance.letter, instance.features) for instance in instances]
+    finally:
+        memory.close()
 
 
-def find_letters(image_path):
-    img = Image.open(image_path)
-    filtered_img = handle_image(img)
-    instances = find_instances(filtered_img)
+def _classify_in_processes(instances, workers, with_features, parameters):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    entries, offset = list(), 0
     for instance in instances:
-            instance.classify()
-    result_image = create_output_image(img, instances)
-    return result_image
+        entries.append((offset, *instance.size))
+        offset += instance.size[0] * instance.size[1]
+
+    memory = shared_memory.SharedMemory(create=True, size=max(1, offset))
+    try:
+        for instance, (offset, width, height) in zip(instances, entries):
+            bitmap = np.ndarray((height, width), dtype=bool, buffer=memory.buf, offset=offset)
+            bitmap[...] = instance.bitmap
+            del bitmap
+
+        chunk_size = -(-len(entries) // (workers * 4))
+        chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+        with ProcessPoolExecutor(workers) as executor:
+            results = executor.map(
+                _classify_shared, [memory.name] * len(chunks), chunks,
+                [with_features] * len(chunks), [parameters] * len(chunks)
+            )
+            for instance, (letter, features) in zip(instances, (result for chunk in results for result in chunk)):
+                instance.letter, instance.features = letter, features
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def classify_instances(instances, *, workers=1, pool='process', with_features=False, profile=None, **parameters):
+    """
+    Classify instances, possibly by pool of workers. Each worker classifies its instances by classify_batch.
+    Results are the same as of Instance.classify for each instance and are stored in instances in their order.
+    :param instances: list of Instance objects
+    :param workers: number of workers, 1 classifies in current thread, None means number of CPUs
+    :param pool: 'process' - instance bitmaps are sent to worker processes through shared memory,
+        'thread' - chunks of instances are classified by threads, it helps as far as feature scaling releases GIL
+    :param with_features: if True instances get all their features
+    :param profile: profiling.Profile object collecting times and counters, or None.
+        Worker processes do not record resizing and feature times, only counters are collected for them.
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: None
+    """
+    parameters = get_parameters(**parameters)
+    workers = workers or os.cpu_count()
+
+    if workers == 1 or len(instances) < 2:
+        classify_batch(instances, with_features=with_features, profile=profile, **parameters)
+    elif pool == 'thread':
+        from concurrent.futures import ThreadPoolExecutor
+
+        chunk_size = -(-len(instances) // (workers * 4))
+        chunks = [instances[i:i + chunk_size] for i in range(0, len(instances), chunk_size)]
+        with ThreadPoolExecutor(workers) as executor:
+            for _ in executor.map(
+                lambda chunk: classify_batch(chunk, with_features=with_features, profile=profile, **parameters),
+                chunks
+            ):
+                pass
+    elif pool == 'process':
+        # rejected instances are not scaled at all, it is cheaper than sending them
+        shared = [instance for instance in instances if is_letter_size(instance.size, **parameters)]
+        for instance in instances:
+            if not is_letter_size(instance.size, **parameters):
+                instance.classify(with_features=with_features, profile=profile, **parameters)
+        if shared:
+            _classify_in_processes(shared, workers, with_features, parameters)
+        if profile is not None:
+            canonical_grid = parameters['canonical_grid']
+            profile.count('resized', sum(1 for instance in shared if canonical_grid or max(instance.size) > 70))
+            profile.count('matched', sum(1 for instance in shared if instance.letter))
+    else:
+        raise ValueError(f"unknown pool type: '{pool}'")
+
+
+def recognize(image, *, with_features=False, workers=1, pool='process', profile=None, cache=None, **parameters):
+    """
+    Find letters on image without drawing them
+    :param image: path to image, open binary file, bytes of image file, PIL.Image.Image object or array-like object,
+        see open_image
+    :param with_features: if True detections have all features of letter instances
+    :param workers: number of workers classifying instances, see classify_instances
+    :param pool: type of workers pool, see classify_instances
+    :param profile: profiling.Profile object collecting times and counters, or None
+    :param cache: cache.ResultCache object, detections of images with the same pixels are taken from it
+    :param parameters: pipeline parameters, see DEFAULT_PARAMETERS
+    :return: list of Detection objects
+    """
+    parameters = get_parameters(**parameters)
+    if cache is not None:
+        # pixels are decoded for cache key, so they are not decoded again, even in coarse to fine search
+        with profile_stage(profile, 'open_image'):
+            image = open_image(image)
+            if isinstance(image, Image.Image):
+                image.load()
+        key = cache.get_key(image, with_features=with_features, **parameters)
+        detections = cache.get(key)
+        if profile is not None:
+            profile.count('cache_hits' if detections is not None else 'cache_misses')
+        if detections is not None:
+            return detections
+
+    detections = _recognize(image, with_features, workers, pool, profile, parameters)
+    if cache is not None:
+        cache.put(key, detections)
+    return detections
+
+
+def _recognize(image, with_features, workers, pool, profile, parameters):
+    if parameters['coarse_factor'] > 1:
+        with profile_stage(profile, 'find_instances'):
+            instances = find_instances_coarse_to_fine(_get_reopenable(image), **parameters)
+        if profile is not None:
+            profile.count('components', len(instances))
+    else:
+        with profile_stage(profile, 'open_image'):
+            img = open_image(image)
+            if isinstance(img, Image.Image):
+                img.load()
+        mask = binarize_image(img, profile=profile, **parameters)
+        with profile_stage(profile, 'find_instances'):
+            instances = find_instances(mask, profile=profile, **parameters)
+
+    with profile_stage(profile, 'classify'):
+        classify_instances(instances, workers=workers, pool=pool, with_features=with_features, profile=profile,
+                           **parameters)
+    return [Detection.from_instance(instance) for instance in instances if instance.letter]
+
+
+def find_letters(image_path, *, profile=None, **parameters):
+    # full resolution image is needed for marking letters anyway, so with coarse_factor it is reduced
+    # after decoding instead of decoding reduced image separately
+    img = open_image(image_path)
+    detections = recognize(img, profile=profile, **parameters)
+    with profile_stage(profile, 'annotate'):
+        return annotate(as_pil_image(img), detections)
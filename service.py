@@ -0,0 +1,307 @@
+"""
+Local HTTP service finding letters on uploaded images.
+
+Run it by `python -m letters_recognition.service`, see `--help` for options.
+POST /recognize with image file as request body gives JSON {"detections": [...]},
+GET /stats gives latency and queue statistics, GET /health answers {"status": "ok"}.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from .batch import _init_worker, _process_chunk
+from .recognition import get_parameters
+
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+    413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _get_error_status(error):
+    """
+    :return: 400 for images which can not be decoded, 503 for failure of worker pool, 500 for other errors
+    """
+    if isinstance(error, BrokenProcessPool):
+        return 503
+    if isinstance(error, (OSError, Image.DecompressionBombError)):
+        return 400
+    return 500
+
+
+class RecognitionService:
+    """
+    Asyncio HTTP server with pool of worker processes prepared before the first request.
+    Requests are queued and sent to workers in batches of requests which came together,
+    if the queue is full new requests are answered with 503 status at once.
+    If a worker process dies, requests of its batch are answered with 503 status and the pool is replaced.
+    """
+    def __init__(self, host='127.0.0.1', port=8080, *, workers=None, max_batch_size=8, batch_delay=0.005,
+                 max_queue=64, max_body_size=32 * 2 ** 20, with_features=False, **parameters):
+        """
+        :param host: host to listen on
+        :param port: port to listen on, 0 means any free port, see attribute port after start
+        :param workers: number of worker processes, by default number of CPUs
+        :param max_batch_size: maximal number of images sent to worker at once
+        :param batch_delay: seconds to wait for more requests to fill batch
+        :param max_queue: maximal number of requests waiting for workers
+        :param max_body_size: maximal size of uploaded image in bytes
+        :param with_features: if True detections have all features of letter instances
+        :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS
+        """
+        self.host, self.port = host, port
+        self.workers = workers or os.cpu_count()
+        self.max_batch_size = max_batch_size
+        self.batch_delay = batch_delay
+        self.max_queue = max_queue
+        self.max_body_size = max_body_size
+        self.with_features = with_features
+        self.parameters = get_parameters(**parameters)
+
+        self.latencies = deque(maxlen=1000)
+        self.counters = dict.fromkeys(
+            ('requests', 'errors', 'rejected', 'batches', 'batched_images', 'pool_restarts'), 0
+        )
+        self._queue = None
+        self._pool = None
+        self._server = None
+        self._batcher = None
+
+    async def start(self):
+        """
+        Start worker processes, wait until they are ready and start listening
+        """
+        loop = asyncio.get_running_loop()
+        self._pool = self._start_pool()
+        await asyncio.gather(*(loop.run_in_executor(self._pool, _warm_up) for _ in range(self.workers)))
+
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._process_queue())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.parameters,))
+
+    def _replace_pool(self, broken_pool):
+        """
+        Start new pool instead of broken one, batches failed together with it do not start more pools
+        """
+        if broken_pool is not self._pool:
+            return
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = self._start_pool()
+        self.counters['pool_restarts'] += 1
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._pool.shutdown(cancel_futures=True)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def get_stats(self):
+        """
+        :return: dictionary with request counters, queue depth and latency in seconds of recent requests
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(share):
+            return latencies[min(len(latencies) - 1, int(share * len(latencies)))] if latencies else None
+
+        return {
+            **self.counters,
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'max_queue': self.max_queue,
+            'workers': self.workers,
+            'mean_batch_size': self.counters['batched_images'] / self.counters['batches']
+            if self.counters['batches'] else None,
+            'latency': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+    async def recognize(self, image):
+        """
+        Queue image and wait for its detections
+        :param image: bytes of image file
+        :return: tuple (list of detection dictionaries, None) or (None, error)
+        :raise asyncio.QueueFull: if queue is full
+        """
+        if self._queue.qsize() >= self.max_queue:
+            raise asyncio.QueueFull
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((image, future))
+        return await future
+
+    async def _process_queue(self):
+        loop = asyncio.get_running_loop()
+        # batches wait in queue while all workers are busy, so queue depth shows the load
+        free_workers = asyncio.Semaphore(self.workers)
+        parameters = {**self.parameters, 'with_features': self.with_features}
+
+        async def run_batch(batch):
+            pool = self._pool
+            try:
+                results = await loop.run_in_executor(
+                    pool, _process_chunk, [image for image, _ in batch], False, parameters
+                )
+            except BrokenProcessPool as error:
+                self._replace_pool(pool)
+                results = [(None, error)] * len(batch)
+            except Exception as error:
+                results = [(None, error)] * len(batch)
+            finally:
+                free_workers.release()
+            for (_, future), (detections, error) in zip(batch, results):
+                if not future.done():
+                    future.set_result((None if detections is None else [detection.to_dict()
+                                                                        for detection in detections], error))
+
+        running = set()
+        while True:
+            await free_workers.acquire()
+            batch = [await self._queue.get()]
+            # requests coming while batch_delay passes after the first one are sent together
+            if self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            self.counters['batches'] += 1
+            self.counters['batched_images'] += len(batch)
+            task = asyncio.create_task(run_batch(batch))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                method, target, version = (request_line.split(' ') + ['', ''])[:3]
+                headers = dict(
+                    (name.strip().lower(), value.strip())
+                    for name, _, value in (line.partition(':') for line in header_lines if line)
+                )
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                status, response, body_read = await self._handle_request(method, target.split('?')[0], headers, reader)
+                if status is None:
+                    break
+                body = json.dumps(response).encode()
+                response_headers = [
+                    f'HTTP/1.1 {status} {REASONS[status]}', 'Content-Type: application/json',
+                    f'Content-Length: {len(body)}', f'Connection: {"keep-alive" if keep_alive else "close"}',
+                ]
+                if status == 503:
+                    response_headers.append('Retry-After: 1')
+                writer.write('\r\n'.join(response_headers + ['', '']).encode('latin-1') + body)
+                await writer.drain()
+                # unread request body would be taken for the next request
+                if not keep_alive or not body_read and method not in ('GET', 'HEAD'):
+                    break
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method, path, headers, reader):
+        """
+        :return: tuple of status code, JSON serializable response and True if request body is read,
+            status is None if client disconnected before request body was read
+        """
+        if path == '/health':
+            return (200, {'status': 'ok'}, True) if method == 'GET' else (405, {'error': 'use GET'}, False)
+        if path == '/stats':
+            return (200, self.get_stats(), True) if method == 'GET' else (405, {'error': 'use GET'}, False)
+        if path != '/recognize':
+            return 404, {'error': f'unknown path {path}'}, False
+        if method != 'POST':
+            return 405, {'error': 'use POST'}, False
+        if 'content-length' not in headers:
+            return 411, {'error': 'Content-Length header is required'}, False
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            return 400, {'error': 'Content-Length header must be non-negative integer'}, False
+        if length > self.max_body_size:
+            return 413, {'error': f'image is larger than {self.max_body_size} bytes'}, False
+
+        start = time.perf_counter()
+        try:
+            image = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # client disconnected while sending image, there is nobody to answer
+            return None, None, False
+        self.counters['requests'] += 1
+        try:
+            detections, error = await self.recognize(image)
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            return 503, {'error': 'too many requests in queue'}, True
+        self.latencies.append(time.perf_counter() - start)
+
+        if error is not None:
+            self.counters['errors'] += 1
+            return _get_error_status(error), {'error': f'{type(error).__name__}: {error}'}, True
+        return 200, {'detections': detections}, True
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m letters_recognition.service', description=__doc__.strip())
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, help='number of worker processes, by default number of CPUs')
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--batch-delay', type=float, default=0.005, help='seconds to wait for more requests')
+    parser.add_argument('--max-queue', type=int, default=64, help='requests waiting for workers before 503 answers')
+    parser.add_argument('--with-features', action='store_true')
+    args = parser.parse_args(args)
+
+    service = RecognitionService(
+        args.host, args.port, workers=args.workers, max_batch_size=args.max_batch_size,
+        batch_delay=args.batch_delay, max_queue=args.max_queue, with_features=args.with_features
+    )
+    try:
+        asyncio.run(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
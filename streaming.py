@@ -0,0 +1,182 @@
+import numpy as np
+
+from .recognition import Instance, Detection, get_parameters, get_cleaning_margin, clean_mask, open_image, \
+    check_component_sizes, get_image_size
+from .tools import get_grayscale, get_histogram, find_otsu_threshold, get_block_histograms, get_block_thresholds, \
+    interpolate_thresholds, binarize, get_runs, label_runs
+
+
+def _read_rows(img, start, stop):
+    """
+    :param img: PIL.Image.Image object or numpy.ndarray given by open_image
+    :param start: the first row
+    :param stop: row after the last one
+    :return: 2-D array of brightness levels of rows
+    """
+    if isinstance(img, np.ndarray):
+        return get_grayscale(img[start:stop])
+    return get_grayscale(img.crop((0, start, img.size[0], stop)))
+
+
+def _find_strip_thresholds(img, strip_height, parameters):
+    """
+    First pass over image strips: collect histograms and find threshold for each strip.
+    :return: function giving threshold value or array of them for (start, stop) range of rows
+    """
+    width, height = get_image_size(img)
+    mode = parameters['threshold_mode']
+
+    if mode == 'global':
+        histogram = sum(
+            get_histogram(_read_rows(img, start, min(start + strip_height, height)))
+            for start in range(0, height, strip_height)
+        )
+        thresh_value = find_otsu_threshold(histogram)
+        return lambda start, stop: thresh_value
+
+    if mode == 'adaptive':
+        block_size = parameters['threshold_block_size']
+        histograms = sum(
+            get_block_histograms(
+                _read_rows(img, start, min(start + strip_height, height)), block_size, (height, width), start
+            )
+            for start in range(0, height, strip_height)
+        )
+        block_thresholds = get_block_thresholds(histograms, parameters['threshold_min_contrast'])
+        return lambda start, stop: interpolate_thresholds(block_thresholds, (height, width), block_size, (start, stop))
+
+    raise ValueError(f"unknown threshold mode: '{mode}'")
+
+
+def _find_touching(upper_starts, upper_ends, lower_starts, lower_ends):
+    """
+    Find pairs of 8-connected runs of two neighbour rows
+    :return: list of (upper run index, lower run index) tuples
+    """
+    first = np.searchsorted(upper_ends, lower_starts, side='left')
+    last = np.searchsorted(upper_starts, lower_ends, side='right')
+    return [
+        (upper, lower)
+        for lower, (first_touching, last_touching) in enumerate(zip(first.tolist(), last.tolist()))
+        for upper in range(first_touching, last_touching)
+    ]
+
+
+def _is_letter_sized(runs, parameters):
+    """
+    :param runs: list of (rows, starts, ends) arrays of component runs
+    :param parameters: pipeline parameters
+    :return: True if component passes size, area and aspect filters
+    """
+    rows = np.concatenate([run[0] for run in runs])
+    starts = np.concatenate([run[1] for run in runs])
+    ends = np.concatenate([run[2] for run in runs])
+    letter_sized, _ = check_component_sizes(
+        [ends.max() - starts.min()], [rows.max() - rows.min() + 1], [(ends - starts).sum()], **parameters
+    )
+    return letter_sized[0]
+
+
+def _make_instance(runs):
+    """
+    :param runs: list of (rows, starts, ends) arrays of component runs
+    :return: Instance object
+    """
+    rows = np.concatenate([run[0] for run in runs])
+    starts = np.concatenate([run[1] for run in runs])
+    ends = np.concatenate([run[2] for run in runs])
+    x_min, y_min = int(starts.min()), int(rows.min())
+
+    bitmap = np.zeros((rows.max() - y_min + 1, ends.max() - x_min), dtype=bool)
+    for row, start, end in zip((rows - y_min).tolist(), (starts - x_min).tolist(), (ends - x_min).tolist()):
+        bitmap[row, start:end] = True
+    return Instance.from_bitmap(bitmap, (x_min, y_min))
+
+
+def find_instances_in_strips(image, strip_height=256, **parameters):
+    """
+    Find instances reading, thresholding, cleaning and labeling image by horizontal strips.
+    Components crossing strip borders are joined, each instance is given as soon as its last row is seen,
+    so memory used for black and white image and components depends on strip height, not on image size.
+    :param image: path to image, open binary file, PIL.Image.Image object or array-like object
+    :param strip_height: number of rows in strip
+    :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS
+    :return: generator of Instance objects
+    """
+    parameters = get_parameters(**parameters)
+    img = open_image(image)
+    width, height = get_image_size(img)
+    get_thresholds = _find_strip_thresholds(img, strip_height, parameters)
+    margin = get_cleaning_margin(**parameters)
+
+    # runs of components which touch the last row of previous strip,
+    # and runs of that row with indices of their pending components
+    pending = list()
+    boundary_starts = boundary_ends = boundary_components = np.zeros(0, dtype=np.intp)
+
+    for start in range(0, height, strip_height):
+        stop = min(start + strip_height, height)
+        read_start, read_stop = max(0, start - margin), min(height, stop + margin)
+
+        grayscale = _read_rows(img, read_start, read_stop)
+        mask = binarize(grayscale, get_thresholds(read_start, read_stop))
+        mask = clean_mask(mask, **parameters)[start - read_start:stop - read_start]
+
+        rows, starts, ends = get_runs(mask)
+        rows += start
+        components, count = label_runs(rows, starts, ends, width)
+
+        order = np.argsort(components, kind='stable')
+        component_runs = [
+            (rows[indices], starts[indices], ends[indices])
+            for indices in np.split(order, np.cumsum(np.bincount(components, minlength=count))[:-1])
+        ] if count else []
+
+        # pending components have group indices 0..len(pending)-1, components of strip go after them
+        groups = list(range(len(pending) + count))
+
+        def find_group(index):
+            while groups[index] != index:
+                groups[index] = index = groups[groups[index]]
+            return index
+
+        first_row = rows == start
+        touching = _find_touching(boundary_starts, boundary_ends, starts[first_row], ends[first_row])
+        for upper, lower in touching:
+            upper_group = find_group(int(boundary_components[upper]))
+            lower_group = find_group(len(pending) + int(components[first_row][lower]))
+            groups[max(upper_group, lower_group)] = min(upper_group, lower_group)
+
+        pending_count = len(pending)
+        group_runs = dict()
+        for index, runs in enumerate(pending + [[runs] for runs in component_runs]):
+            group_runs.setdefault(find_group(index), list()).extend(runs)
+
+        last_row = rows == stop - 1
+        last_row_groups = [find_group(pending_count + component) for component in components[last_row].tolist()]
+
+        pending, pending_indices = list(), dict()
+        for group, runs in group_runs.items():
+            if stop < height and group in last_row_groups:
+                pending_indices[group] = len(pending)
+                pending.append(runs)
+            elif _is_letter_sized(runs, parameters):
+                yield _make_instance(runs)
+
+        boundary_starts, boundary_ends = starts[last_row], ends[last_row]
+        boundary_components = np.array([pending_indices.get(group, -1) for group in last_row_groups], dtype=np.intp)
+
+
+def recognize_in_strips(image, strip_height=256, *, with_features=False, **parameters):
+    """
+    Find letters reading image by horizontal strips, see find_instances_in_strips
+    :param image: path to image, open binary file, PIL.Image.Image object or array-like object
+    :param strip_height: number of rows in strip
+    :param with_features: if True detections have all features of letter instances
+    :param parameters: pipeline parameters, see recognition.DEFAULT_PARAMETERS
+    :return: generator of Detection objects, given as soon as the last rows of letters are read
+    """
+    for instance in find_instances_in_strips(image, strip_height, **parameters):
+        instance.classify(with_features=with_features, **parameters)
+        if instance.letter:
+            yield Detection.from_instance(instance)
@@ -1,7 +1,48 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import signal
+import tempfile
 import unittest
-from itertools import combinations
+from concurrent.futures.process import BrokenProcessPool
+from itertools import combinations, product
+from unittest import mock
 
-from .features import LETTERS_DETERMINATION
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
+
+from . import __main__ as cli_module
+from .__main__ import main as run_cli
+from . import batch as batch_module
+from .batch import find_letters_batch
+from . import cache as cache_module
+from . import recognition as recognition_module
+from .cache import ResultCache
+from . import service as service_module
+from .service import RecognitionService
+from .frames import FrameRecognizer, recognize_frames
+from .benchmarks import render_page, get_accuracy, compare_with_baseline, run_case, run_stages, get_peak_memory, \
+    measure_import, check_import, STAGES
+from .streaming import find_instances_in_strips, recognize_in_strips
+from .profiling import Profile
+from .features import LETTERS_DETERMINATION, DistanceMap, find_features, get_template, has_C_circle, \
+    LazyFeatures, match_letter, LetterMatcher, LETTERS_MATCHER, get_feature_funcs, register_feature, \
+    register_template, FEATURE_FUNCS, TEMPLATE_FUNCS, find_features_batch, build_templates
+from .recognition import Instance, Detection, binarize_image, handle_image, recognize, annotate, find_letters, \
+    get_font, find_instances, classify_instances, classify_batch, open_raw_frame, open_image, open_coarse_image
+from .tools import get_package_dir_path, WHITE, BLACK, get_brightness, get_grayscale, get_pixels_with_color, \
+    find_brightness_threshold, expand_black_areas, find_otsu_threshold, get_neighbours, label_components, \
+    get_structuring_element, dilate, erode, opening, mask_to_image, get_locality, get_runs, RunLengthImage, \
+    binarize, find_image_threshold
+
+
+def draw_text(text, size=(400, 120), font_size=60):
+    image = Image.new('RGB', size, WHITE)
+    font = ImageFont.truetype(os.path.join(get_package_dir_path(), 'OpenSans-Regular.ttf'), font_size)
+    ImageDraw.Draw(image).text((10, 10), text, fill=BLACK, font=font)
+    return image
 
 
 class LetterDeterminationTestCase(unittest.TestCase):
@@ -24,3 +65,932 @@ class LetterDeterminationTestCase(unittest.TestCase):
                 letter2_both_features,
                 msg=f"'{letter1}' and '{letter2}' letters has similar both feature values"
             )
+
+
+class BinarizationTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.image = Image.fromarray(rng.integers(0, 256, (23, 31, 3), dtype=np.uint8), 'RGB')
+
+    def test_grayscale_matches_brightness(self):
+        grayscale = get_grayscale(self.image)
+        brightness = get_brightness(self.image)
+
+        self.assertEqual(grayscale.shape, (23, 31))
+        for (x, y), bright in brightness.items():
+            self.assertEqual(grayscale[y, x], bright)
+
+    def test_binarize_image_matches_pixel_filtration(self):
+        brightness = get_brightness(self.image)
+        thresh_value = find_brightness_threshold(brightness)
+        self.assertEqual(find_brightness_threshold(get_grayscale(self.image)), thresh_value)
+
+        filtered_image = Image.new('RGB', self.image.size, WHITE)
+        pixels = filtered_image.load()
+        for (i, j), bright in brightness.items():
+            pixels[i, j] = WHITE if bright > thresh_value else BLACK
+        black_pixels = get_pixels_with_color(filtered_image, BLACK)
+        for pixel in set().union(*(get_neighbours(p) for p in black_pixels)):
+            if 0 <= pixel[0] < self.image.size[0] and 0 <= pixel[1] < self.image.size[1]:
+                pixels[pixel] = BLACK
+        expected = get_pixels_with_color(filtered_image, BLACK)
+        thresholded_image = mask_to_image(binarize_image(self.image, dilation_size=1))
+        self.assertEqual(get_pixels_with_color(expand_black_areas(thresholded_image), BLACK), expected)
+
+        mask = binarize_image(self.image)
+        self.assertEqual(sorted(zip(*np.nonzero(mask.T))), sorted(expected))
+        self.assertEqual(get_pixels_with_color(handle_image(self.image), BLACK), expected)
+
+
+class ThresholdTestCase(unittest.TestCase):
+    @staticmethod
+    def otsu_by_loop(histogram):
+        levels = [level for level, count in enumerate(histogram) if count]
+        all_pixel_count = sum(histogram)
+        all_intensity_sum = sum(level * count for level, count in enumerate(histogram))
+
+        first_class_pixel_count = first_class_intensity_sum = 0
+        best_thresh = best_sigma = 0
+        for thresh in levels[:-1]:
+            first_class_pixel_count += histogram[thresh]
+            first_class_intensity_sum += thresh * histogram[thresh]
+            first_class_prob = first_class_pixel_count / all_pixel_count
+            first_class_mean = first_class_intensity_sum / first_class_pixel_count
+            second_class_mean = (all_intensity_sum - first_class_intensity_sum) / \
+                (all_pixel_count - first_class_pixel_count)
+            sigma = first_class_prob * (1 - first_class_prob) * (first_class_mean - second_class_mean) ** 2
+            if sigma > best_sigma:
+                best_sigma, best_thresh = sigma, thresh
+        return best_thresh
+
+    def test_histogram_otsu(self):
+        rng = np.random.default_rng(1)
+        histograms = [rng.integers(0, 50, 256) * (rng.random(256) < density) for density in (0.02, 0.3, 1)]
+        histograms += [np.bincount([7, 7, 7], minlength=256), np.zeros(256, dtype=int)]
+
+        for histogram in histograms:
+            self.assertEqual(find_otsu_threshold(histogram), self.otsu_by_loop(histogram.tolist()))
+        self.assertEqual(
+            find_otsu_threshold(np.stack(histograms)).tolist(),
+            [self.otsu_by_loop(histogram.tolist()) for histogram in histograms]
+        )
+
+    def test_adaptive_threshold_handles_uneven_lighting(self):
+        lighting = np.linspace(240, 100, 256)
+        grayscale = np.repeat(lighting[None, :], 128, axis=0)
+        grayscale[60:68, 20:108] -= 80
+        grayscale[60:68, 148:236] -= 80
+        image = Image.fromarray(grayscale.round().astype(np.uint8), 'L')
+
+        self.assertTrue(binarize_image(image)[:, 200:].all())
+
+        mask = binarize_image(image, threshold_mode='adaptive', threshold_block_size=32)
+        expected = np.zeros_like(mask)
+        expected[59:69, 19:109] = expected[59:69, 147:237] = True
+        np.testing.assert_array_equal(mask, expected)
+
+    def test_unknown_parameters(self):
+        image = Image.new('L', (4, 4))
+        self.assertRaises(TypeError, binarize_image, image, threshold='otsu')
+        self.assertRaises(ValueError, binarize_image, image, threshold_mode='otsu')
+
+
+class LabelingTestCase(unittest.TestCase):
+    @staticmethod
+    def components_by_search(mask):
+        black_pixels = set(zip(*(coords.tolist() for coords in np.nonzero(mask.T))))
+        components = set()
+        while black_pixels:
+            component, next_pixels = set(), {black_pixels.pop()}
+            while next_pixels:
+                component.update(next_pixels)
+                next_pixels = set().union(*[get_neighbours(p) for p in next_pixels]) & black_pixels
+                black_pixels -= next_pixels
+            components.add(frozenset(component))
+        return components
+
+    def test_components_match_search(self):
+        rng = np.random.default_rng(2)
+        for density in (0.05, 0.3, 0.5, 0.7):
+            mask = rng.random((37, 41)) < density
+            labels, stats = label_components(mask)
+
+            components = set()
+            for label, (x_min, y_min, x_max, y_max, area) in enumerate(stats.tolist(), start=1):
+                y_vals, x_vals = np.nonzero(labels == label)
+                self.assertEqual((x_vals.min(), y_vals.min(), x_vals.max(), y_vals.max()), (x_min, y_min, x_max, y_max))
+                self.assertEqual(len(x_vals), area)
+                components.add(frozenset(zip(x_vals.tolist(), y_vals.tolist())))
+
+            self.assertEqual(components, self.components_by_search(mask))
+            self.assertEqual(labels.astype(bool).tolist(), mask.tolist())
+
+    def test_empty_mask(self):
+        labels, stats = label_components(np.zeros((3, 4), dtype=bool))
+        self.assertFalse(labels.any())
+        self.assertEqual(stats.shape, (0, 5))
+
+
+class MorphologyTestCase(unittest.TestCase):
+    @staticmethod
+    def apply_by_pixels(mask, element, erosion):
+        result = np.full_like(mask, erosion)
+        for y, x, i, j in product(*(range(s) for s in mask.shape + element.shape)):
+            y_near, x_near = y + i - element.shape[0] // 2, x + j - element.shape[1] // 2
+            inside = 0 <= y_near < mask.shape[0] and 0 <= x_near < mask.shape[1]
+            if element[i, j] and inside and mask[y_near, x_near] != erosion:
+                result[y, x] = not erosion
+        return result
+
+    def test_operations_match_definition(self):
+        rng = np.random.default_rng(3)
+        for size, shape in product((1, 2, 3, (5, 4)), ('square', 'cross', 'diamond', 'disk')):
+            element = get_structuring_element(size, shape)
+            mask = rng.random((9, 11)) < 0.3
+            np.testing.assert_array_equal(dilate(mask, size, shape), self.apply_by_pixels(mask, element, False))
+            np.testing.assert_array_equal(
+                dilate(mask, element, iterations=2),
+                self.apply_by_pixels(self.apply_by_pixels(mask, element, False), element, False)
+            )
+            np.testing.assert_array_equal(erode(~mask, size, shape), self.apply_by_pixels(~mask, element, True))
+
+    def test_opening_removes_specks(self):
+        mask = np.zeros((20, 20), dtype=bool)
+        mask[2, 3] = mask[15, 16:18] = True
+        mask[5:15, 5:9] = True
+
+        expected = np.zeros_like(mask)
+        expected[5:15, 5:9] = True
+        np.testing.assert_array_equal(opening(mask, 3), expected)
+        self.assertFalse(opening(mask, 5, 'disk')[:5].any())
+
+
+class RunLengthTestCase(unittest.TestCase):
+    def test_runs_convert_to_dense_form_and_back(self):
+        mask = np.zeros((4, 6), dtype=bool)
+        mask[0, :2] = mask[0, 5] = mask[1, 5] = mask[2, 0] = mask[3] = True
+        rows, starts, ends = get_runs(mask)
+        self.assertEqual((rows.tolist(), starts.tolist(), ends.tolist()),
+                         ([0, 0, 1, 2, 3], [0, 5, 5, 0, 0], [2, 6, 6, 1, 6]))
+
+        runs = RunLengthImage.from_mask(mask)
+        self.assertEqual((len(runs), runs.area, runs.size), (5, 11, (6, 4)))
+        np.testing.assert_array_equal(runs.to_mask(), mask)
+        np.testing.assert_array_equal(runs.invert().to_mask(), ~mask)
+        np.testing.assert_array_equal(RunLengthImage.from_mask(np.zeros((3, 0), dtype=bool)).to_mask(),
+                                      np.zeros((3, 0), dtype=bool))
+
+    def test_operations_match_dense_ones(self):
+        rng = np.random.default_rng(8)
+        for size, shape in product((1, 2, 3, (5, 4), rng.random((3, 4)) < 0.5), ('square', 'cross', 'disk')):
+            mask = rng.random((17, 23)) < 0.3
+            runs = RunLengthImage.from_mask(mask)
+            np.testing.assert_array_equal(runs.dilate(size, shape, 2).to_mask(), dilate(mask, size, shape, 2))
+            np.testing.assert_array_equal(runs.erode(size, shape).to_mask(), erode(mask, size, shape))
+            np.testing.assert_array_equal(runs.opening(size, shape).to_mask(), opening(mask, size, shape))
+            np.testing.assert_array_equal(runs.label()[1], label_components(mask)[1])
+
+    def test_pipeline_gives_the_same_instances(self):
+        image = draw_text('ABC DEF', font_size=50)
+        for parameters in ({}, {'opening_size': 2}):
+            runs = binarize_image(image, run_length=True, **parameters)
+            self.assertIsInstance(runs, RunLengthImage)
+            np.testing.assert_array_equal(runs.to_mask(), binarize_image(image, **parameters))
+            self.assertEqual([(instance.start_pix, instance.bitmap.tolist()) for instance in find_instances(runs)],
+                             [(instance.start_pix, instance.bitmap.tolist())
+                              for instance in find_instances(binarize_image(image, **parameters))])
+        self.assertEqual(recognize(image, run_length=True), recognize(image))
+
+
+class DistanceMapTestCase(unittest.TestCase):
+    def test_distances_match_localities(self):
+        rng = np.random.default_rng(4)
+        mask = rng.random((17, 13)) < 0.05
+        mask[0, 0] = mask[-1, -1] = True
+        instance = Instance(list(zip(*(coords.tolist() for coords in np.nonzero(mask.T)))))
+        instance_pixels = set(instance.pixels)
+        distance_map = DistanceMap(instance)
+
+        pixels = list(product(range(-3, 16), range(-3, 20)))
+        for area_size in (0, 1, 3, (0, 2), (2, 0), (3, 4)):
+            limit = area_size[0] if isinstance(area_size, tuple) else area_size
+            distances = distance_map.get_distances(pixels, area_size)
+            for pixel, distance in zip(pixels, distances):
+                self.assertEqual(
+                    distance <= limit, not instance_pixels.isdisjoint(get_locality(pixel, area_size)),
+                    msg=f'{pixel} {area_size}'
+                )
+
+    def test_features_with_distance(self):
+        pixels = [(x, y) for x in range(40) for y in range(60) if x < 6 or y < 6 or y >= 54]
+        features = find_features(Instance(pixels))
+        features_with_distance = find_features(Instance(pixels), with_distance=True)
+
+        self.assertEqual({name: value[0] for name, value in features_with_distance.items()}, features)
+        self.assertTrue(features['left_vertical_line'])
+        self.assertEqual(features_with_distance['upper_horizont_line'][1], 0)
+        self.assertGreater(features_with_distance['right_vertical_line'][1], 40 // 10)
+
+
+class TemplateTestCase(unittest.TestCase):
+    def test_templates_are_cached(self):
+        verifying_pixels, eps = get_template('C_circle', (31, 47))
+        self.assertIs(get_template('C_circle', (31, 47))[0], verifying_pixels)
+        self.assertFalse(verifying_pixels.flags.writeable)
+
+        pixels = [tuple(p) for p in verifying_pixels.tolist()]
+        self.assertTrue(has_C_circle(Instance(pixels + [(0, 0), (30, 46)])))
+
+    def test_canonical_grid_uses_one_template_size(self):
+        instances = [
+            Instance([(x, y) for x in range(width) for y in range(height) if x < 4 or y < 4 or y >= height - 4])
+            for width, height in ((20, 30), (33, 41), (90, 120))
+        ]
+        feature_count = len(find_features(instances[0]))
+
+        get_template.cache_clear()
+        for instance in instances:
+            instance.classify(canonical_grid=(50, 70))
+        self.assertLessEqual(get_template.cache_info().misses, feature_count)
+
+
+class FeatureRegistryTestCase(unittest.TestCase):
+    def test_builtin_features_are_registered(self):
+        self.assertEqual(set(get_feature_funcs()), set().union(*LETTERS_DETERMINATION.values()))
+        self.assertEqual(set(TEMPLATE_FUNCS), set(get_feature_funcs()))
+        self.assertIs(get_feature_funcs()['C_circle'], has_C_circle)
+
+    def test_custom_feature(self):
+        self.addCleanup(FEATURE_FUNCS.pop, 'wide', None)
+        self.addCleanup(TEMPLATE_FUNCS.pop, 'upper_left_corner', None)
+
+        @register_feature(name='wide')
+        def is_wide(instance, *, _show_area=False, with_distance=False):
+            return (instance.size[0] > instance.size[1], 0.) if with_distance else instance.size[0] > instance.size[1]
+
+        @register_template('upper_left_corner')
+        def upper_left_corner(size):
+            return {(0, 0)}, (1, 1)
+
+        instance = Instance([(x, y) for x in range(40) for y in range(20)])
+        self.assertIs(find_features(instance)['wide'], True)
+        self.assertIs(LazyFeatures(instance)['wide'], True)
+        self.assertEqual(get_template('upper_left_corner', (40, 20))[0].tolist(), [[0, 0]])
+        with self.assertRaises(ValueError):
+            register_feature(is_wide, name='wide')
+
+    def test_feature_without_template(self):
+        self.addCleanup(FEATURE_FUNCS.pop, 'wide_box', None)
+
+        @register_feature
+        def has_wide_box(instance, *, _show_area=False, with_distance=False):
+            return instance.size[0] > instance.size[1]
+
+        build_templates((50, 70))
+        image = draw_text('AB')
+        detections = recognize(image, with_features=True, canonical_grid=(50, 70))
+        self.assertTrue(detections)
+        # features are scaled for instances resampled to canonical grid
+        self.assertIs(detections[0].features['wide_box'], False)
+        self.assertEqual(recognize(image, canonical_grid=(50, 70)), recognize(image, canonical_grid=(50, 70),
+                                                                              workers=2, pool='thread'))
+
+
+class LazyFeaturesTestCase(unittest.TestCase):
+    def test_match_letter_gives_first_matching_letter(self):
+        feature_names = sorted(set().union(*LETTERS_DETERMINATION.values()))
+        for values in product((False, True), repeat=len(feature_names)):
+            features = dict(zip(feature_names, values))
+            expected = next((
+                letter for letter, letter_features in LETTERS_DETERMINATION.items()
+                if set(letter_features.items()).issubset(features.items())
+            ), None)
+            self.assertEqual(match_letter(features), expected)
+
+    def test_features_are_scaled_on_demand(self):
+        instance = Instance([(x, y) for x in range(40) for y in range(60) if x < 6 or y < 6 or y >= 54])
+        features = LazyFeatures(instance)
+
+        self.assertEqual(match_letter(features), match_letter(find_features(instance)))
+        self.assertLess(len(features.computed), len(features))
+        self.assertEqual(dict(features), find_features(instance))
+
+
+class LetterMatcherTestCase(unittest.TestCase):
+    def test_bits_match_like_features(self):
+        rng = np.random.default_rng(5)
+        for values in rng.random((200, len(LETTERS_MATCHER.feature_names))) < 0.5:
+            features = dict(zip(LETTERS_MATCHER.feature_names, values.tolist()))
+            value_bits = sum(1 << i for i, value in enumerate(values) if value)
+            self.assertEqual(LETTERS_MATCHER.match_bits(value_bits), match_letter(features))
+
+    def test_matrix_matches_like_features(self):
+        rng = np.random.default_rng(6)
+        feature_names = list(reversed(LETTERS_MATCHER.feature_names))
+        values = rng.random((200, len(feature_names))) < 0.5
+        self.assertEqual(LETTERS_MATCHER.match_matrix(values, feature_names),
+                         [match_letter(dict(zip(feature_names, row))) for row in values.tolist()])
+
+    def test_ambiguous_determination_is_rejected(self):
+        letters_determination = {
+            'X': {'left_vertical_line': True, 'C_circle': False},
+            'Y': {'left_vertical_line': True, 'D_belly': True},
+        }
+        self.assertRaises(ValueError, LetterMatcher, letters_determination)
+
+        letters_determination['Y']['C_circle'] = True
+        features = {'left_vertical_line': True, 'C_circle': True, 'D_belly': True}
+        self.assertEqual(LetterMatcher(letters_determination).match(features), 'Y')
+
+
+class BatchTestCase(unittest.TestCase):
+    def test_batch_isolates_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, f'{text}.png') for text in ('ABC', 'DEF')]
+            for path in paths:
+                draw_text(os.path.basename(path)[:3]).save(path)
+            missing_path = os.path.join(directory, 'missing.png')
+
+            image_file = io.BytesIO()
+            draw_text('CAB').save(image_file, 'PNG')
+            image_file.seek(0)
+
+            results = list(find_letters_batch(paths + [missing_path, image_file], workers=2, chunksize=2))
+
+        self.assertEqual(len(results), 4)
+        results = {source if isinstance(source, str) else 'file': (result, error) for source, result, error in results}
+        self.assertIsInstance(results[missing_path][1], FileNotFoundError)
+        for source in paths + ['file']:
+            result, error = results[source]
+            self.assertIsNone(error)
+            self.assertEqual(result.size, (400, 120))
+
+
+    def test_worker_failure_is_isolated(self):
+        def crash(source, **parameters):
+            if 'crash' in source:
+                os._exit(1)
+            return recognize(source, **parameters)
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, f'{name}.png') for name in ('0', '1', 'crash', '3', '4', '5')]
+            for path in paths:
+                draw_text('AB').save(path)
+            with mock.patch.object(batch_module, 'recognize', side_effect=crash):
+                results = list(find_letters_batch(paths, workers=2, chunksize=2, annotate=False))
+
+        self.assertEqual(sorted(source for source, _, _ in results), sorted(paths))
+        for source, detections, error in results:
+            if 'crash' in source:
+                self.assertIsInstance(error, BrokenProcessPool)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual([detection.letter for detection in detections], ['A', 'B'])
+
+
+class RecognizeTestCase(unittest.TestCase):
+    def test_detections(self):
+        image = draw_text('ABC')
+        detections = sorted(recognize(image), key=lambda detection: detection.bbox)
+
+        self.assertEqual([detection.letter for detection in detections], ['A', 'B', 'C'])
+        for detection in detections:
+            self.assertIsNone(detection.features)
+            self.assertEqual(detection.bbox[:2], detection.start_pix)
+            self.assertEqual(set(detection.to_dict()), {'letter', 'bbox', 'start_pix'})
+
+        with_features = sorted(recognize(image, with_features=True), key=lambda detection: detection.bbox)
+        self.assertEqual([detection.bbox for detection in with_features], [detection.bbox for detection in detections])
+        self.assertEqual(with_features[0].features.keys(), get_feature_funcs().keys())
+
+    def test_annotation_is_opt_in(self):
+        image = draw_text('ABC')
+        self.assertEqual(annotate(image, recognize(image)).tobytes(), find_letters(image).tobytes())
+        self.assertIs(get_font(12), get_font(12))
+        self.assertEqual(Detection('A', (1, 2), (3, 4)).bbox, (1, 2, 4, 6))
+
+    def test_parallel_classification_keeps_order(self):
+        image = draw_text('ABCEFH', size=(500, 120))
+        expected = recognize(image, with_features=True)
+        for pool in ('thread', 'process'):
+            detections = recognize(image, with_features=True, workers=2, pool=pool)
+            self.assertEqual([detection.to_dict() for detection in detections],
+                             [detection.to_dict() for detection in expected], msg=pool)
+            self.assertEqual([detection.features for detection in detections],
+                             [detection.features for detection in expected], msg=pool)
+        with self.assertRaises(ValueError):
+            classify_instances(find_instances(binarize_image(image))[:2], workers=2, pool='fiber')
+
+
+class InstanceTestCase(unittest.TestCase):
+    def test_bitmap_representation(self):
+        pixels = [(5, 7), (6, 7), (8, 9)]
+        instance = Instance(pixels)
+        self.assertEqual(instance.start_pix, (5, 7))
+        self.assertEqual(instance.size, (4, 3))
+        self.assertEqual(sorted(instance.pixels), [(0, 0), (1, 0), (3, 2)])
+        self.assertEqual(instance.bitmap.tolist(), [[True, True, False, False], [False] * 4,
+                                                    [False, False, False, True]])
+        self.assertEqual(Instance(pixels, size=(10, 10)).size, (10, 10))
+        self.assertFalse(hasattr(instance, '__dict__'))
+
+        same = Instance.from_bitmap(instance.bitmap, (5, 7))
+        self.assertEqual((same.start_pix, same.size, same.pixels), (instance.start_pix, instance.size, instance.pixels))
+
+    def test_resampling(self):
+        instance = Instance([(x, y) for x in range(40) for y in range(60) if x < 6 or y < 6 or y >= 54])
+        resized = instance.get_resized(0.5)
+        self.assertEqual(resized.size, (20, 30))
+        self.assertTrue(resized.bitmap[:, 0].all())
+        self.assertFalse(resized.bitmap[15, 10:].any())
+        self.assertEqual(instance.get_normalized((50, 70)).size, (50, 70))
+
+    def test_features_are_scaled_for_all_instances_at_once(self):
+        rng = np.random.default_rng(7)
+        sizes = zip(rng.integers(5, 60, 60), rng.integers(5, 60, 60), rng.random(60))
+        instances = [Instance.from_bitmap(rng.random((height, width)) < density) for width, height, density in sizes]
+        instances += [Instance.from_bitmap(np.zeros((30, 20), dtype=bool))] * 2
+        values, distances = find_features_batch(instances, with_distance=True)
+        for instance, instance_values, instance_distances in zip(instances, values.tolist(), distances.tolist()):
+            self.assertEqual(find_features(instance, with_distance=True),
+                             dict(zip(get_feature_funcs(), zip(instance_values, instance_distances))))
+
+    def test_batch_is_classified_like_instances(self):
+        image = draw_text('ABCDEFHJ', size=(500, 300), font_size=100)
+        for parameters in ({}, {'canonical_grid': (40, 56)}):
+            instances = find_instances(image, **parameters)
+            together = [Instance.from_bitmap(instance.bitmap, instance.start_pix) for instance in instances]
+            classify_batch(together, with_features=True, **parameters)
+            for instance, batched in zip(instances, together):
+                instance.classify(with_features=True, **parameters)
+                self.assertEqual((batched.letter, batched.features), (instance.letter, instance.features))
+            self.assertTrue(any(instance.letter for instance in together))
+
+
+class InputTestCase(unittest.TestCase):
+    def test_arrays_are_not_copied(self):
+        grayscale = np.asarray(draw_text('ABC').convert('L'))
+        self.assertTrue(np.shares_memory(get_grayscale(open_image(grayscale)), grayscale))
+        self.assertTrue(np.shares_memory(get_grayscale(open_image(memoryview(grayscale))), grayscale))
+        self.assertTrue(np.shares_memory(get_grayscale(open_image(grayscale[..., None])), grayscale))
+
+        rgb = np.asarray(draw_text('ABC'))
+        self.assertTrue((get_grayscale(rgb) == get_grayscale(draw_text('ABC'))).all())
+
+    def test_array_inputs(self):
+        image = draw_text('ABC')
+        expected = [detection.to_dict() for detection in recognize(image)]
+        grayscale = np.ascontiguousarray(np.asarray(image)[..., 0])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frame.raw')
+            grayscale.tofile(path)
+            frame = open_raw_frame(path, grayscale.shape)
+            for source in (np.asarray(image), grayscale, memoryview(grayscale), frame):
+                self.assertEqual([detection.to_dict() for detection in recognize(source)], expected)
+            self.assertEqual(len(recognize(frame, coarse_factor=2)), 3)
+            self.assertEqual(len(list(recognize_in_strips(frame, 16))), 3)
+            self.assertEqual(find_letters(frame).tobytes(), find_letters(image).tobytes())
+            del frame
+
+    def test_arrays_of_other_types_are_scaled(self):
+        image = draw_text('ABC')
+        expected = [detection.to_dict() for detection in recognize(image)]
+        grayscale = np.ascontiguousarray(np.asarray(image)[..., 0])
+        np.testing.assert_array_equal(get_grayscale(grayscale[..., None]), grayscale)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frame16.raw')
+            (grayscale.astype(np.uint16) * 257).tofile(path)
+            frame = open_raw_frame(path, grayscale.shape, np.uint16)
+            np.testing.assert_array_equal(get_grayscale(frame), grayscale)
+            for source in (frame, np.asarray(image).astype(np.uint16) * 256, grayscale / 255):
+                self.assertEqual([detection.to_dict() for detection in recognize(source)], expected)
+            self.assertEqual(len(recognize(frame, coarse_factor=2)), 3)
+            self.assertEqual(find_letters(frame).tobytes(), find_letters(image).tobytes())
+            del frame
+        self.assertRaises(ValueError, get_grayscale, grayscale.astype(np.complex64))
+
+
+class FramesTestCase(unittest.TestCase):
+    @staticmethod
+    def make_frames():
+        page = np.asarray(draw_text('ABC\nEFH', size=(400, 200), font_size=50).convert('L'))
+        moved = np.full_like(page, 255)
+        moved[:, 30:] = page[:, :-30]
+        erased = moved.copy()
+        erased[80:, :] = 255
+        speck = erased.copy()
+        speck[5:8, 5:8] = 0
+        return [page, page, moved, erased, speck, speck, page]
+
+    def test_frames_give_same_detections(self):
+        # adaptive thresholds of blocks change with content, so they are found again for each frame
+        for drift, parameters in [(0.02, {}), (0.02, {'opening_size': 2}),
+                                  (0, {'threshold_mode': 'adaptive', 'threshold_block_size': 32})]:
+            for with_features in (False, True):
+                expected = [recognize(frame, with_features=with_features, **parameters)
+                            for frame in self.make_frames()]
+                found = list(recognize_frames(self.make_frames(), with_features=with_features,
+                                              max_histogram_drift=drift, **parameters))
+                self.assertEqual(found, expected, msg=f'{parameters} {with_features}')
+                self.assertEqual([[detection.features for detection in detections] for detections in found],
+                                 [[detection.features for detection in detections] for detections in expected])
+
+    def test_work_is_reused(self):
+        recognizer = FrameRecognizer()
+        for frame in self.make_frames():
+            recognizer.recognize(frame)
+        self.assertEqual(recognizer.stats['frames'], 7)
+        self.assertEqual(recognizer.stats['threshold_updates'], 1)
+        self.assertEqual(recognizer.stats['unchanged_frames'], 2)
+        # erasing and speck do not touch upper letters, moved letters are found again, not classified
+        self.assertGreaterEqual(recognizer.stats['reused'], 6)
+
+        dark = (self.make_frames()[0] // 2)
+        recognizer.recognize(dark)
+        self.assertEqual(recognizer.stats['threshold_updates'], 2)
+        recognizer.recognize(np.zeros((10, 10), dtype=np.uint8))
+        self.assertEqual(recognizer.stats['threshold_updates'], 3)
+
+
+class ComponentFilterTestCase(unittest.TestCase):
+    def test_components_are_filtered_before_instances(self):
+        mask = np.zeros((200, 300), dtype=bool)
+        mask[10:12, 10:12] = True           # speck
+        mask[20:60, 30:70] = True           # letter sized
+        mask[100:102, 10:290] = True        # too wide line
+        mask[110:190, 150:250] = True       # big blob
+
+        def boxes(**parameters):
+            return sorted((instance.start_pix, instance.size) for instance in find_instances(mask, **parameters))
+
+        self.assertEqual(boxes(), [((30, 20), (40, 40)), ((150, 110), (100, 80))])
+        self.assertEqual(boxes(dilation_size=1, max_component_size=90), [((30, 20), (40, 40))])
+        self.assertEqual(boxes(max_component_area=1600), [((30, 20), (40, 40))])
+        self.assertEqual(len(boxes(min_component_size=1, max_aspect=1000, min_aspect=0)), 4)
+
+        profile = Profile()
+        find_instances(mask, profile=profile, max_component_size=90)
+        self.assertEqual(profile.counters, {'components': 4, 'oversized': 2, 'rejected': 1})
+
+    def test_filter_parameters_reach_classification(self):
+        image = draw_text('ABC')
+        self.assertEqual(recognize(image, max_component_area=10), [])
+        self.assertEqual(list(recognize_in_strips(image, 16, max_component_size=10)), [])
+        self.assertEqual(len(recognize(image, coarse_factor=2)), 3)
+        self.assertEqual(recognize(image, coarse_factor=2, max_component_size=10), [])
+
+
+class ProfileTestCase(unittest.TestCase):
+    def test_stages_and_counters(self):
+        image = draw_text('ABC')
+        records = list()
+        profile = Profile(callback=lambda *record: records.append(record))
+        self.assertEqual(find_letters(image, profile=profile).tobytes(), find_letters(image).tobytes())
+
+        result = profile.to_dict()
+        for stage in ('open_image', 'grayscale', 'threshold', 'binarize', 'clean_mask', 'find_instances', 'classify',
+                      'annotate'):
+            self.assertEqual(result['calls'][stage], 1, msg=stage)
+        self.assertTrue(any(name.startswith('feature.') for name in result['times']))
+        self.assertEqual(result['counters']['matched'], 3)
+        self.assertEqual(result['counters']['components'],
+                         result['counters']['matched'] + result['counters'].get('rejected', 0))
+        self.assertEqual(result['counters']['black_pixels'],
+                         np.count_nonzero(binarize_image(image, dilation_size=1)))
+        self.assertIn(('count', 'matched', 3), records)
+
+
+class StreamingTestCase(unittest.TestCase):
+    @staticmethod
+    def instance_keys(instances):
+        return sorted((instance.start_pix, instance.size, sorted(instance.pixels)) for instance in instances)
+
+    def test_strips_give_same_instances(self):
+        image = draw_text('ABC\nHIJ', size=(300, 200), font_size=50)
+        for parameters in ({}, {'threshold_mode': 'adaptive', 'threshold_block_size': 32},
+                           {'opening_size': 3, 'dilation_size': 5, 'dilation_shape': 'disk'}):
+            expected = self.instance_keys(find_instances(binarize_image(image, **parameters)))
+            for strip_height in (1, 7, 64, 500):
+                instances = find_instances_in_strips(image, strip_height, **parameters)
+                self.assertEqual(self.instance_keys(instances), expected, msg=f'{parameters} {strip_height}')
+
+    def test_detections_are_given_by_strips(self):
+        image = draw_text('ABC')
+        detections = recognize_in_strips(image, 16)
+        self.assertEqual(sorted(detection.letter for detection in detections), ['A', 'B', 'C'])
+
+
+class CoarseToFineTestCase(unittest.TestCase):
+    def test_coarse_detections_match_full_resolution(self):
+        image_file = io.BytesIO()
+        draw_text('ABC\nEFH', size=(600, 400), font_size=110).save(image_file, 'JPEG', quality=95)
+
+        for factor in (2, 4):
+            image_file.seek(0)
+            detections = sorted(recognize(image_file, coarse_factor=factor), key=lambda detection: detection.bbox)
+            expected = sorted(recognize(Image.open(image_file)), key=lambda detection: detection.bbox)
+
+            self.assertEqual([d.letter for d in detections], [d.letter for d in expected])
+            for detection, expected_detection in zip(detections, expected):
+                self.assertLessEqual(np.abs(np.subtract(detection.bbox, expected_detection.bbox)).max(), 2)
+
+    def test_size_not_divisible_by_factor(self):
+        image_file = io.BytesIO()
+        draw_text('ABC\nEFH', size=(1203, 801), font_size=200).save(image_file, 'JPEG', quality=95)
+        self.assertEqual(open_coarse_image(image_file.getvalue(), 4).size, (300, 200))
+        self.assertEqual(open_coarse_image(draw_text('A', size=(1203, 801)), 4).size, (301, 201))
+
+        detections = sorted(recognize(image_file.getvalue(), coarse_factor=4), key=lambda detection: detection.bbox)
+        expected = sorted(recognize(image_file.getvalue()), key=lambda detection: detection.bbox)
+        self.assertEqual([d.letter for d in detections], [d.letter for d in expected])
+        for detection, expected_detection in zip(detections, expected):
+            self.assertLessEqual(np.abs(np.subtract(detection.bbox, expected_detection.bbox)).max(), 2)
+
+    def test_palette_and_bilevel_images(self):
+        image = draw_text('ABC')
+        for mode, image_format in (('P', 'GIF'), ('P', 'PNG'), ('1', 'PNG'), ('1', 'TIFF')):
+            image_file = io.BytesIO()
+            image.convert(mode).save(image_file, image_format)
+            self.assertEqual(open_coarse_image(image_file.getvalue(), 2).size, (200, 60))
+            detections = recognize(image_file.getvalue(), coarse_factor=2)
+            self.assertEqual(sorted(detection.letter for detection in detections), ['A', 'B', 'C'])
+
+    def test_threshold_is_found_at_full_resolution(self):
+        image = draw_text('ABC EFH', size=(800, 200), font_size=90)
+        expected = find_brightness_threshold(get_grayscale(image))
+        self.assertEqual(find_image_threshold(image), expected)
+        self.assertEqual(find_image_threshold(image.convert('L')), expected)
+
+        with mock.patch.object(recognition_module, 'binarize', wraps=binarize) as binarize_mock:
+            recognize(image, coarse_factor=8)
+        # the first call binarizes reduced image, the rest binarize crops of full resolution image
+        self.assertEqual({call.args[1] for call in binarize_mock.call_args_list[1:]}, {expected})
+
+    def test_only_crops_are_processed_at_full_resolution(self):
+        image, _ = render_page((800, 600), font_size=40, density=0.1, letters='ABC')
+        sizes = list()
+
+        def counted_grayscale(img):
+            grayscale = get_grayscale(img)
+            sizes.append(grayscale.size)
+            return grayscale
+
+        with mock.patch.object(recognition_module, 'get_grayscale', side_effect=counted_grayscale):
+            recognize(image, coarse_factor=4)
+        self.assertLess(sum(sizes), image.size[0] * image.size[1] / 2)
+
+    def test_image_is_opened_once(self):
+        image_file = io.BytesIO()
+        draw_text('ABC').save(image_file, 'JPEG', quality=95)
+        for factor in (1, 4):
+            with mock.patch.object(Image, 'open', wraps=Image.open) as image_open:
+                find_letters(io.BytesIO(image_file.getvalue()), coarse_factor=factor)
+            self.assertEqual(image_open.call_count, 1)
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def test_synthetic_page(self):
+        image, truth = render_page((300, 200), font_size=40, density=1.0, letters='ABC')
+        self.assertEqual(image.size, (300, 200))
+        self.assertTrue(truth)
+        self.assertEqual({letter for letter, _ in truth}, {'A', 'B', 'C'})
+        self.assertEqual(render_page((300, 200), scale=2)[0].size, (600, 400))
+
+        self.assertEqual(get_accuracy(truth, truth), {'recall': 1.0, 'precision': 1.0})
+        shifted = [(letter, (x_min + 1, y_min, x_max + 1, y_max)) for letter, (x_min, y_min, x_max, y_max) in truth]
+        self.assertEqual(get_accuracy(shifted[1:] + [('J', truth[0][1])], truth)['precision'], 1 - 1 / len(truth))
+
+    def test_regressions_are_found(self):
+        result = run_case({'size': (200, 100), 'density': 1.0, 'letters': 'AB'}, repeat=1)
+        self.assertEqual(result['stages'].keys(), set(STAGES))
+        self.assertEqual(result['peak_memory'].keys(), set(STAGES))
+        self.assertGreater(result['recall'], 0.5)
+
+        baseline = {'case': result}
+        self.assertEqual(compare_with_baseline({'case': result}, baseline), [])
+        slower = {'case': dict(result, stages=dict(result['stages'], classify=result['stages']['classify'] * 2))}
+        regressions = compare_with_baseline(slower, baseline, margin=0.5)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('classify', regressions[0])
+
+    def test_stages_take_parameters(self):
+        image, truth = render_page((300, 200), font_size=40, density=1.0, letters='ABC')
+        _, instances = run_stages(image)
+        _, run_instances = run_stages(image, run_length=True)
+        self.assertEqual([(instance.start_pix, instance.letter) for instance in run_instances],
+                         [(instance.start_pix, instance.letter) for instance in instances])
+        self.assertEqual(run_stages(image, min_component_size=100)[1], [])
+        self.assertEqual(set(get_peak_memory(image, run_length=True)), set(STAGES))
+
+    def test_import_is_within_budget(self):
+        result = measure_import(repeat=1)
+        self.assertEqual(result['eager_modules'], [])
+        self.assertEqual(check_import(result), [])
+        self.assertEqual(len(check_import(dict(result, eager_modules=['asyncio']), budget=0)), 2)
+
+
+class ServiceTestCase(unittest.TestCase):
+    @staticmethod
+    def request(port, method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def run_with_service(self, requests, **options):
+        async def run():
+            async with RecognitionService(port=0, workers=1, **options) as service:
+                loop = asyncio.get_running_loop()
+                responses = await asyncio.gather(*(
+                    loop.run_in_executor(None, self.request, service.port, *request) for request in requests
+                ))
+                return responses, service.get_stats()
+        return asyncio.run(run())
+
+    def test_recognition_requests(self):
+        file = io.BytesIO()
+        draw_text('ABC').save(file, 'PNG')
+        image = file.getvalue()
+        expected = [detection.to_dict() for detection in recognize(image)]
+
+        responses, stats = self.run_with_service(
+            [('POST', '/recognize', image)] * 4 + [('POST', '/recognize', b'not an image')], batch_delay=0.05
+        )
+        self.assertEqual(responses[:4], [(200, {'detections': expected})] * 4)
+        self.assertEqual(responses[4][0], 400)
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['batched_images'], 5)
+        self.assertLess(stats['batches'], 5)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertIsNotNone(stats['latency']['p95'])
+
+    def test_other_requests(self):
+        responses, stats = self.run_with_service(
+            [('POST', '/recognize', b'image'), ('GET', '/stats'), ('GET', '/health'), ('GET', '/recognize'),
+             ('GET', '/unknown')], max_queue=0
+        )
+        self.assertEqual([status for status, _ in responses], [503, 200, 200, 405, 404])
+        self.assertEqual(responses[2][1], {'status': 'ok'})
+        self.assertEqual(stats['rejected'], 1)
+
+    def test_invalid_content_length(self):
+        async def send(port, length):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'POST /recognize HTTP/1.1\r\nContent-Length: {length}\r\n\r\nimage'.encode())
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response.split(b' ', 2)[1]
+
+        async def run():
+            async with RecognitionService(port=0, workers=1) as service:
+                return [await send(service.port, length) for length in ('abc', '-5')]
+        self.assertEqual(asyncio.run(run()), [b'400', b'400'])
+
+    def test_client_disconnects_during_upload(self):
+        async def run():
+            async with RecognitionService(port=0, workers=1) as service:
+                errors = list()
+                asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+                reader, writer = await asyncio.open_connection('127.0.0.1', service.port)
+                writer.write(b'POST /recognize HTTP/1.1\r\nContent-Length: 1000\r\n\r\nabc')
+                await writer.drain()
+                writer.write_eof()
+                response = await reader.read()
+                writer.close()
+                await asyncio.sleep(0.1)
+                return errors, response, service.get_stats()['requests']
+
+        self.assertEqual(asyncio.run(run()), ([], b'', 0))
+
+    def test_pool_is_replaced_after_worker_failure(self):
+        file = io.BytesIO()
+        draw_text('ABC').save(file, 'PNG')
+
+        async def run():
+            async with RecognitionService(port=0, workers=1) as service:
+                loop = asyncio.get_running_loop()
+                for pid in list(service._pool._processes):
+                    os.kill(pid, signal.SIGKILL)
+                await asyncio.sleep(0.5)
+                responses = [await loop.run_in_executor(None, self.request, service.port, 'POST', '/recognize',
+                                                        file.getvalue()) for _ in range(2)]
+                return responses, service.get_stats()
+
+        responses, stats = asyncio.run(run())
+        self.assertEqual([status for status, _ in responses], [503, 200])
+        self.assertEqual(len(responses[1][1]['detections']), 3)
+        self.assertEqual(stats['pool_restarts'], 1)
+
+    def test_error_statuses(self):
+        self.assertEqual(service_module._get_error_status(UnidentifiedImageError('not an image')), 400)
+        self.assertEqual(service_module._get_error_status(BrokenProcessPool()), 503)
+        self.assertEqual(service_module._get_error_status(ValueError()), 500)
+
+
+class CommandLineTestCase(unittest.TestCase):
+    def test_resumable_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            images = os.path.join(directory, 'images')
+            os.makedirs(os.path.join(images, 'sub'))
+            draw_text('AB').save(os.path.join(images, 'ab.png'))
+            draw_text('C').save(os.path.join(images, 'sub', 'c.png'))
+            with open(os.path.join(images, 'broken.jpg'), 'wb') as file:
+                file.write(b'not an image')
+
+            output, manifest = os.path.join(directory, 'out.ndjson'), os.path.join(directory, 'done.txt')
+            arguments = [images, '-j', '1', '-o', output, '--manifest', manifest]
+            self.assertEqual(run_cli(arguments + ['--annotate-dir', os.path.join(directory, 'annotated')]), 1)
+            with open(output) as file:
+                records = {os.path.basename(record['path']): record for record in map(json.loads, file)}
+            self.assertEqual([detection['letter'] for detection in records['ab.png']['detections']], ['A', 'B'])
+            self.assertEqual([detection['letter'] for detection in records['c.png']['detections']], ['C'])
+            self.assertIn('error', records['broken.jpg'])
+            annotated = [name for _, _, names in os.walk(os.path.join(directory, 'annotated')) for name in names]
+            self.assertEqual(sorted(annotated), ['ab.png', 'c.png'])
+
+            # only failed image is tried again
+            self.assertEqual(run_cli(arguments), 1)
+            with open(output) as file:
+                paths = [os.path.basename(json.loads(line)['path']) for line in file]
+            self.assertEqual(sorted(paths), ['ab.png', 'broken.jpg', 'broken.jpg', 'c.png'])
+
+
+    def test_worker_failure_does_not_stop_run(self):
+        def crash(source, **parameters):
+            if 'crash' in source:
+                os._exit(1)
+            return recognize(source, **parameters)
+
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('a', 'crash', 'c'):
+                draw_text('AB').save(os.path.join(directory, f'{name}.png'))
+            output, manifest = os.path.join(directory, 'out.ndjson'), os.path.join(directory, 'done.txt')
+            with mock.patch.object(batch_module, 'recognize', side_effect=crash):
+                self.assertEqual(run_cli([directory, '-j', '2', '--chunksize', '2', '-o', output,
+                                          '--manifest', manifest]), 1)
+            with open(output) as file:
+                records = {os.path.basename(record['path']): record for record in map(json.loads, file)}
+            with open(manifest) as file:
+                done = sorted(os.path.basename(line.rstrip('\n')) for line in file)
+
+        self.assertEqual(sorted(records), ['a.png', 'c.png', 'crash.png'])
+        self.assertIn('BrokenProcessPool', records['crash.png']['error'])
+        self.assertEqual([detection['letter'] for detection in records['c.png']['detections']], ['A', 'B'])
+        self.assertEqual(done, ['a.png', 'c.png'])
+
+    def test_pool_failure_gives_exit_code(self):
+        with tempfile.TemporaryDirectory() as directory:
+            draw_text('AB').save(os.path.join(directory, 'a.png'))
+            with mock.patch.object(cli_module, 'find_letters_batch', side_effect=BrokenProcessPool('failed')), \
+                    mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                self.assertEqual(run_cli([directory, '-o', os.path.join(directory, 'out.ndjson')]), 1)
+        self.assertIn('worker processes failed', stderr.getvalue())
+
+
+class CacheTestCase(unittest.TestCase):
+    def test_repeated_images(self):
+        image = draw_text('ABC')
+        expected = recognize(image, with_features=True)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+            profile = Profile()
+            self.assertEqual(recognize(image, cache=cache, with_features=True, profile=profile), expected)
+
+            # the same pixels in other file format
+            file = io.BytesIO()
+            image.save(file, 'BMP')
+            cached = recognize(file.getvalue(), cache=cache, with_features=True, profile=profile)
+            self.assertEqual([detection.to_dict() for detection in cached],
+                             [detection.to_dict() for detection in expected])
+            self.assertEqual((profile.counters['cache_misses'], profile.counters['cache_hits']), (1, 1))
+            self.assertEqual(profile.calls['classify'], 1)
+
+            key = cache.get_key(image, with_features=True)
+            self.assertNotEqual(cache.get_key(image), key)
+            self.assertNotEqual(cache.get_key(image, with_features=True, dilation_size=5), key)
+            self.assertNotEqual(cache.get_key(draw_text('ABD'), with_features=True), key)
+            with mock.patch.object(cache_module, 'get_code_fingerprint', return_value='changed rules'):
+                self.assertNotEqual(cache.get_key(image, with_features=True), key)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory, max_size=10 ** 6)
+            detections = [Detection('A', (i, i), (10, 10)) for i in range(100)]
+            for i in range(5):
+                cache.put(f'{i:064x}', detections)
+                os.utime(cache._get_path(f'{i:064x}'), (i, i))
+            entry_size = os.path.getsize(cache._get_path(f'{0:064x}'))
+            self.assertEqual(cache.get(f'{0:064x}'), detections)
+
+            cache.evict(entry_size * 2)
+            self.assertEqual([cache.get(f'{i:064x}') is not None for i in range(5)],
+                             [True, False, False, False, True])
+            cache.clear()
+            self.assertIsNone(cache.get(f'{4:064x}'))
@@ -2,7 +2,8 @@ import os
 from collections import Counter
 from itertools import product
 
-from PIL import Image, ImageDraw
+import numpy as np
+from PIL import Image
 
 
 WHITE = (255, 255, 255)
@@ -12,6 +13,8 @@ GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
 PINK = (255, 0, 255)
 
+LUMA_COEFFICIENTS = (0.299, 0.587, 0.114)
+
 
 def get_brightness(img):
     """
@@ -22,11 +25,216 @@ def get_brightness(img):
     pixels = img.load()
     brightness = dict()
     for i, j in product(*(range(s) for s in img.size)):
-        brightness[(i, j)] = round(sum(p * c for p, c in zip(pixels[i, j], (0.299, 0.587, 0.114))))
+        brightness[(i, j)] = round(sum(p * c for p, c in zip(pixels[i, j], LUMA_COEFFICIENTS)))
 
     return brightness
 
 
+def get_uint8_scale(dtype):
+    """
+    :param dtype: numpy type of pixel values
+    :return: factor turning values into range from 0 to 255: integer values are taken from the whole range
+        of their type, float and bool values from 0 to 1
+    :raise ValueError: if type is not numeric
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        return 255 / np.iinfo(dtype).max
+    if dtype.kind in 'fb':
+        return 255.
+    raise ValueError(f"unsupported type of pixel values: {dtype}")
+
+
+def to_uint8(array):
+    """
+    :param array: numpy.ndarray of pixel values, see get_uint8_scale
+    :return: uint8 array, the same one if it is uint8 already, values out of range are clipped
+    """
+    if array.dtype == np.uint8:
+        return array
+    return np.clip(np.rint(array * get_uint8_scale(array.dtype)), 0, 255).astype(np.uint8)
+
+
+def get_grayscale(img):
+    """
+    Find brightness level of each pixel as a 2-D array.
+    Gives the same values as get_brightness, but indexed as [y, x].
+    :param img: PIL.Image.Image object or numpy.ndarray indexed as [y, x], 2-D or 3-D with 1 channel for grayscale
+        image (uint8 array is returned as is, without copying) or 3-D with RGB(A) channels.
+        Arrays of other types are scaled to uint8, see to_uint8
+    :return: numpy.ndarray of uint8 with shape (height, width)
+    """
+    if isinstance(img, np.ndarray):
+        if img.ndim == 3 and img.shape[2] == 1:
+            img = img[..., 0]
+        if img.ndim == 2:
+            return to_uint8(img)
+        rgb = img[..., :3].astype(np.float64)
+        if img.dtype != np.uint8:
+            rgb *= get_uint8_scale(img.dtype)
+    elif img.mode == 'L':
+        return np.asarray(img, dtype=np.uint8)
+    else:
+        rgb = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'), dtype=np.float64)
+
+    brightness = rgb[..., 0] * LUMA_COEFFICIENTS[0]
+    brightness += rgb[..., 1] * LUMA_COEFFICIENTS[1]
+    brightness += rgb[..., 2] * LUMA_COEFFICIENTS[2]
+    return np.ascontiguousarray(np.clip(np.rint(brightness), 0, 255), dtype=np.uint8)
+
+
+def binarize(grayscale, thresh):
+    """
+    Turn brightness levels into a binary image
+    :param grayscale: 2-D array of brightness levels
+    :param thresh: threshold value or array of them for each pixel, pixels brighter than it become white
+    :return: numpy.ndarray of bool with shape (height, width), True for black pixels
+    """
+    return grayscale <= thresh
+
+
+def get_structuring_element(size=3, shape='square'):
+    """
+    Make structuring element for morphological operations
+    :param size: integer side of element or tuple (width, height)
+    :param shape: 'square' (rectangle for tuple size), 'cross', 'diamond' or 'disk' (ellipse for tuple size)
+    :return: 2-D bool array with shape (height, width), its center is at [height // 2, width // 2]
+    """
+    width, height = (size, size) if isinstance(size, int) else size
+    if width < 1 or height < 1:
+        raise ValueError(f"structuring element size must be positive, got {size}")
+
+    y_offsets = np.arange(height)[:, None] - height // 2
+    x_offsets = np.arange(width)[None, :] - width // 2
+    y_norm = y_offsets / (height // 2) if height > 1 else y_offsets * 0.
+    x_norm = x_offsets / (width // 2) if width > 1 else x_offsets * 0.
+
+    if shape == 'square':
+        return np.ones((height, width), dtype=bool)
+    if shape == 'cross':
+        return (y_offsets == 0) | (x_offsets == 0)
+    if shape == 'diamond':
+        return np.abs(y_norm) + np.abs(x_norm) <= 1
+    if shape == 'disk':
+        return y_norm ** 2 + x_norm ** 2 <= 1
+    raise ValueError(f"unknown structuring element shape: '{shape}'")
+
+
+def _get_element(kernel, shape):
+    return np.asarray(kernel, dtype=bool) if np.ndim(kernel) == 2 else get_structuring_element(kernel, shape)
+
+
+def _reflect(element):
+    """
+    Reflect structuring element through its center
+    """
+    reflected = element[::-1, ::-1]
+    # even sized element gets one more row or column to keep its center in place
+    return np.pad(reflected, ((1 - element.shape[0] % 2, 0), (1 - element.shape[1] % 2, 0)))
+
+
+def _or_shifted(result, mask, y_offset, x_offset):
+    """
+    Make result[y, x] |= mask[y + y_offset, x + x_offset] for pixels inside the image
+    """
+    height, width = mask.shape
+    if abs(y_offset) >= height or abs(x_offset) >= width:
+        return
+    result[max(0, -y_offset):height - max(0, y_offset), max(0, -x_offset):width - max(0, x_offset)] |= \
+        mask[max(0, y_offset):height - max(0, -y_offset), max(0, x_offset):width - max(0, -x_offset)]
+
+
+def dilate(mask, kernel=3, shape='square', iterations=1):
+    """
+    Binary dilation: pixel becomes black if there is a black pixel under structuring element placed at it.
+    Rectangles are processed by separable passes, other elements by OR of shifted images,
+    so cost depends on element size, not on number of black pixels.
+    :param mask: 2-D bool array, True for black pixels
+    :param kernel: size of element (see get_structuring_element) or 2-D bool array of element itself
+    :param shape: shape of element when kernel is given by size
+    :param iterations: number of times dilation is applied
+    :return: new 2-D bool array
+    """
+    element = _get_element(kernel, shape)
+    height, width = element.shape
+    y_offsets, x_offsets = np.nonzero(element)
+    y_offsets, x_offsets = (y_offsets - height // 2).tolist(), (x_offsets - width // 2).tolist()
+    separable = element.all()
+
+    result = mask.copy()
+    for _ in range(iterations):
+        source = result
+        if separable:
+            rows = source.copy()
+            for x_offset in range(-(width // 2), width - width // 2):
+                _or_shifted(rows, source, 0, x_offset)
+            result = rows.copy()
+            for y_offset in range(-(height // 2), height - height // 2):
+                _or_shifted(result, rows, y_offset, 0)
+        else:
+            result = np.zeros_like(source)
+            for y_offset, x_offset in zip(y_offsets, x_offsets):
+                _or_shifted(result, source, y_offset, x_offset)
+    return result
+
+
+def erode(mask, kernel=3, shape='square', iterations=1):
+    """
+    Binary erosion: pixel stays black if all pixels under structuring element placed at it are black.
+    Pixels outside the image are considered black, so erosion is dual to dilation.
+    :param mask: 2-D bool array, True for black pixels
+    :param kernel: size of element (see get_structuring_element) or 2-D bool array of element itself
+    :param shape: shape of element when kernel is given by size
+    :param iterations: number of times erosion is applied
+    :return: new 2-D bool array
+    """
+    return ~dilate(~mask, _get_element(kernel, shape), iterations=iterations)
+
+
+def opening(mask, kernel=3, shape='square', iterations=1):
+    """
+    Binary opening: erosion followed by dilation. Removes black specks smaller than structuring element.
+    :param mask: 2-D bool array, True for black pixels
+    :param kernel: size of element (see get_structuring_element) or 2-D bool array of element itself
+    :param shape: shape of element when kernel is given by size
+    :param iterations: number of erosions and then of dilations
+    :return: new 2-D bool array
+    """
+    element = _get_element(kernel, shape)
+    return dilate(erode(mask, element, iterations=iterations), _reflect(element), iterations=iterations)
+
+
+def closing(mask, kernel=3, shape='square', iterations=1):
+    """
+    Binary closing: dilation followed by erosion. Fills white gaps smaller than structuring element.
+    :param mask: 2-D bool array, True for black pixels
+    :param kernel: size of element (see get_structuring_element) or 2-D bool array of element itself
+    :param shape: shape of element when kernel is given by size
+    :param iterations: number of dilations and then of erosions
+    :return: new 2-D bool array
+    """
+    element = _get_element(kernel, shape)
+    return erode(dilate(mask, _reflect(element), iterations=iterations), element, iterations=iterations)
+
+
+def expand_black_mask(mask):
+    """
+    Expand black areas of binary image by one pixel in every direction
+    :param mask: 2-D bool array, True for black pixels
+    :return: new 2-D bool array
+    """
+    return dilate(mask)
+
+
+def mask_to_image(mask):
+    """
+    Convert binary image to black and white PIL image
+    :param mask: 2-D bool array, True for black pixels
+    :return: PIL.Image.Image object in 'RGB' mode
+    """
+    return Image.fromarray(np.where(mask, 0, 255).astype(np.uint8), 'L').convert('RGB')
+
+
 def expand_black_areas(img):
     """
     Expand black areas of image
@@ -34,42 +242,45 @@ def expand_black_areas(img):
     :return: PIL.Image.Image object
     """
     new_img = img.copy()
-    pixels = new_img.load()
-    size = img.size
-
-    edge_pixels = set()
-    for i, j in product(*(range(s) for s in size)):
-        if pixels[i, j] == BLACK:
-            edge_pixels.update(get_neighbours([i, j]))
-
-    edge_pixels = [(i, j) for i, j in edge_pixels if 0 <= i < size[0] and 0 <= j < size[1]]
-
-    for i, j in edge_pixels:
-        pixels[i, j] = BLACK
+    pixels = np.array(img.convert('RGB'))
+    black = (pixels == BLACK).all(axis=-1)
+    expanded = Image.fromarray(dilate(black) & ~black)
+    new_img.paste(BLACK if img.mode == 'RGB' else 0, mask=expanded)
 
     return new_img
 
 
-def find_brightness_threshold(brightness):
+def get_histogram(brightness):
     """
-    Find the best threshold value using the Otsu method
+    Count pixels of each brightness level in a single pass
     :param brightness: dictionary with tuple of pixels coordinates as keys and brightness level as values
-    :return: the best threshold value
+        or 2-D array of brightness levels
+    :return: numpy.ndarray with 256 pixel counts
     """
-    histogram = Counter(val for pix, val in brightness.items())
+    if isinstance(brightness, np.ndarray):
+        return np.bincount(brightness.ravel(), minlength=256)
+
+    histogram = np.zeros(256, dtype=np.int64)
+    for val, count in Counter(brightness.values()).items():
+        histogram[val] = count
+    return histogram
 
-    all_intensity_sum = sum(brightness.values())
-    all_pixel_count = len(brightness)
 
-    first_class_pixel_count = 0
-    first_class_intensity_sum = 0
+def _otsu(histograms):
+    """
+    Otsu method over the last axis of histograms
+    :param histograms: array of pixel counts with shape (..., 256)
+    :return: tuple of best threshold values and mean brightness of both classes for them
+    """
+    histograms = np.asarray(histograms, dtype=np.int64)
+    levels = np.arange(histograms.shape[-1])
 
-    best_thresh = 0
-    best_sigma = 0
+    all_pixel_count = histograms.sum(axis=-1, keepdims=True)
+    all_intensity_sum = (histograms * levels).sum(axis=-1, keepdims=True)
+    first_class_pixel_count = np.cumsum(histograms, axis=-1)
+    first_class_intensity_sum = np.cumsum(histograms * levels, axis=-1)
 
-    for thresh in sorted(histogram.keys())[:-1]:
-        first_class_pixel_count += histogram[thresh]
-        first_class_intensity_sum += thresh * histogram[thresh]
+    with np.errstate(divide='ignore', invalid='ignore'):
         first_class_prob = first_class_pixel_count / all_pixel_count
         first_class_mean = first_class_intensity_sum / first_class_pixel_count
 
@@ -81,11 +292,424 @@ def find_brightness_threshold(brightness):
         mean_delta = first_class_mean - second_class_mean
         sigma = first_class_prob * second_class_prob * mean_delta ** 2
 
-        if sigma > best_sigma:
-            best_sigma = sigma
-            best_thresh = thresh
+    # only levels present in the histogram split pixels into two non-empty classes
+    sigma = np.where((histograms > 0) & (second_class_pixel_count > 0), sigma, 0)
+    best_thresh = np.argmax(sigma, axis=-1)[..., None]
+    found = np.take_along_axis(sigma, best_thresh, axis=-1)[..., 0] > 0
+
+    class_means = [
+        np.where(found, np.take_along_axis(np.nan_to_num(mean), best_thresh, axis=-1)[..., 0], 0)
+        for mean in (first_class_mean, second_class_mean)
+    ]
+    return (np.where(found, best_thresh[..., 0], 0), *class_means)
+
+
+def find_otsu_threshold(histogram):
+    """
+    Find the best threshold value using the Otsu method.
+    Costs O(256) for a single histogram, several histograms can be given at once.
+    :param histogram: array of 256 pixel counts or array of such histograms with shape (..., 256)
+    :return: the best threshold value or array of them
+    """
+    thresh, _, _ = _otsu(histogram)
+    return int(thresh) if thresh.ndim == 0 else thresh
+
 
-    return best_thresh
+def find_brightness_threshold(brightness):
+    """
+    Find the best threshold value using the Otsu method
+    :param brightness: dictionary with tuple of pixels coordinates as keys and brightness level as values
+        or 2-D array of brightness levels
+    :return: the best threshold value
+    """
+    return find_otsu_threshold(get_histogram(brightness))
+
+
+def find_image_threshold(img):
+    """
+    Find the best threshold value of whole image using the Otsu method.
+    Pixels are counted by PIL without making array of brightness levels, brightness of color pixels is found
+    in integer arithmetic then, so for a few colors it differs by 1 from get_grayscale.
+    :param img: PIL.Image.Image object
+    :return: the best threshold value
+    """
+    return find_otsu_threshold((img if img.mode == 'L' else img.convert('L')).histogram())
+
+
+def get_block_histograms(grayscale, block_size, shape=None, first_row=0):
+    """
+    Count pixels of each brightness level in square blocks of image
+    :param grayscale: 2-D array of brightness levels of whole image or of its consecutive rows
+    :param block_size: side of square block in pixels
+    :param shape: (height, width) of whole image, by default it is shape of grayscale
+    :param first_row: index of the first row of grayscale in whole image
+    :return: int array with shape (blocks by height, blocks by width, 256),
+        histograms of several parts of image can be summed up
+    """
+    height, width = grayscale.shape if shape is None else shape
+    block_rows = -(-height // block_size)
+    block_cols = -(-width // block_size)
+
+    row_blocks = (np.arange(first_row, first_row + grayscale.shape[0]) // block_size)[:, None]
+    block_index = row_blocks * block_cols + np.arange(width) // block_size
+    return np.bincount(
+        (block_index * 256 + grayscale).ravel(), minlength=block_rows * block_cols * 256
+    ).reshape(block_rows, block_cols, 256)
+
+
+def get_block_thresholds(histograms, min_contrast=0):
+    """
+    Find threshold values of blocks by their histograms.
+    Blocks are split into ink and paper classes by the Otsu method and take the value between means of classes.
+    Blocks where difference between means of classes is less than min_contrast
+    are considered as blank paper and take threshold value min_contrast below their mean brightness.
+    :param histograms: array made by get_block_histograms
+    :param min_contrast: minimal brightness difference between ink and paper
+    :return: 2-D array of threshold values with shape (blocks by height, blocks by width)
+    """
+    _, ink_mean, paper_mean = _otsu(histograms)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_brightness = histograms @ np.arange(256) / histograms.sum(axis=-1)
+    return np.where(
+        paper_mean - ink_mean >= min_contrast,
+        np.floor((ink_mean + paper_mean) / 2),
+        np.floor(mean_brightness - min_contrast)
+    )
+
+
+def find_block_thresholds(grayscale, block_size, min_contrast=0):
+    """
+    Find threshold values of image blocks, see get_block_thresholds
+    :param grayscale: 2-D array of brightness levels
+    :param block_size: side of square block in pixels
+    :param min_contrast: minimal brightness difference between ink and paper
+    :return: 2-D array of threshold values with shape (blocks by height, blocks by width)
+    """
+    return get_block_thresholds(get_block_histograms(grayscale, block_size), min_contrast)
+
+
+def interpolate_thresholds(block_thresholds, shape, block_size, rows=None):
+    """
+    Bilinear interpolation of block threshold values between block centers
+    :param block_thresholds: 2-D array made by find_block_thresholds
+    :param shape: (height, width) of image
+    :param block_size: side of square block in pixels
+    :param rows: optional (start, stop) range of image rows to interpolate only for them
+    :return: 2-D float32 array of threshold value for each pixel (of given rows)
+    """
+    def axis_weights(positions, blocks):
+        position = np.clip((positions + 0.5) / block_size - 0.5, 0, blocks - 1)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, blocks - 1)
+        return lower, upper, (position - lower).astype(np.float32)
+
+    block_thresholds = block_thresholds.astype(np.float32)
+    top, bottom, y_weight = axis_weights(np.arange(*(rows or (shape[0],))), block_thresholds.shape[0])
+    left, right, x_weight = axis_weights(np.arange(shape[1]), block_thresholds.shape[1])
+
+    rows = block_thresholds[top] * (1 - y_weight[:, None]) + block_thresholds[bottom] * y_weight[:, None]
+    return rows[:, left] * (1 - x_weight) + rows[:, right] * x_weight
+
+
+def get_runs(mask):
+    """
+    Find horizontal runs of black pixels
+    :param mask: 2-D bool array, True for black pixels
+    :return: tuple of int arrays (rows, starts, ends) ordered by rows and starts, ends are exclusive
+    """
+    height, width = mask.shape
+    # rows are joined with one white pixel after each of them, so runs of flat array do not cross rows
+    flat = np.zeros((height, width + 1), dtype=bool)
+    flat[:, :width] = mask
+    flat = flat.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    if len(flat) and flat[0]:
+        changes = np.concatenate([[0], changes])
+    rows, starts = np.divmod(changes[0::2], width + 1)
+    ends = changes[1::2] - rows * (width + 1)
+    return rows, starts, ends
+
+
+def label_runs(rows, starts, ends, width):
+    """
+    Join 8-connected runs into components with union-find
+    :param rows: int array of run rows, runs are ordered by rows and starts
+    :param starts: int array of run starts
+    :param ends: int array of exclusive run ends
+    :param width: image width
+    :return: tuple (int array of component index of each run, number of components),
+        components are numbered in order of their first run
+    """
+    if not len(rows):
+        return np.zeros(0, dtype=np.intp), 0
+
+    row_length = width + 2
+    start_keys = rows * row_length + starts
+    end_keys = rows * row_length + ends
+
+    # runs of the previous row which touch a run, including diagonal neighbours, lie in [first, last)
+    first = np.searchsorted(end_keys, start_keys - row_length, side='left')
+    last = np.searchsorted(start_keys, end_keys - row_length, side='right')
+
+    parents = list(range(len(rows)))
+
+    def find_root(run):
+        while parents[run] != run:
+            parents[run] = run = parents[parents[run]]
+        return run
+
+    touching = np.flatnonzero(first < last)
+    for run, first_touching, last_touching in zip(
+            touching.tolist(), first[touching].tolist(), last[touching].tolist()):
+        for other in range(first_touching, last_touching):
+            root, other_root = find_root(run), find_root(other)
+            if root != other_root:
+                parents[max(root, other_root)] = min(root, other_root)
+
+    # parents always have smaller indices, so one pass in order links every run to its root
+    for run in range(len(parents)):
+        parents[run] = parents[parents[run]]
+
+    roots, components = np.unique(np.array(parents), return_inverse=True)
+    return components, len(roots)
+
+
+def get_run_stats(rows, starts, ends, components, count, size):
+    """
+    Find bounding boxes and areas of components made of runs
+    :param rows: int array of run rows
+    :param starts: int array of run starts
+    :param ends: int array of exclusive run ends
+    :param components: int array of component index of each run, see label_runs
+    :param count: number of components
+    :param size: (width, height) of image
+    :return: int array with shape (components, 5) with columns x_min, y_min, x_max, y_max (inclusive) and area
+    """
+    stats = np.zeros((count, 5), dtype=np.int64)
+    stats[:, 0] = size[0]
+    stats[:, 1] = size[1]
+    np.minimum.at(stats[:, 0], components, starts)
+    np.minimum.at(stats[:, 1], components, rows)
+    np.maximum.at(stats[:, 2], components, ends - 1)
+    np.maximum.at(stats[:, 3], components, rows)
+    stats[:, 4] = np.bincount(components, weights=ends - starts, minlength=count)
+    return stats
+
+
+def fill_runs(array, rows, starts, ends, values=True):
+    """
+    Set pixels of runs in 2-D array
+    :param array: 2-D array to change
+    :param rows: int array of run rows
+    :param starts: int array of run starts
+    :param ends: int array of exclusive run ends
+    :param values: value for all runs or array of value of each run
+    :return: array
+    """
+    lengths = ends - starts
+    run_offsets = np.cumsum(lengths) - lengths
+    flat_indices = np.repeat(rows * array.shape[1] + starts - run_offsets, lengths) + np.arange(lengths.sum())
+    array.ravel()[flat_indices] = np.repeat(values, lengths) if np.ndim(values) else values
+    return array
+
+
+def label_components(mask):
+    """
+    Find 8-connected components of black pixels in linear time
+    :param mask: 2-D bool array, True for black pixels
+    :return: tuple (labels, stats), where labels is 2-D int32 array with 0 for white pixels and
+        component number starting from 1 for black ones, stats is int array with shape (components, 5)
+        and columns x_min, y_min, x_max, y_max (inclusive) and area of component number row + 1
+    """
+    height, width = mask.shape
+    rows, starts, ends = get_runs(mask)
+    components, count = label_runs(rows, starts, ends, width)
+    stats = get_run_stats(rows, starts, ends, components, count, (width, height))
+    labels = fill_runs(np.zeros((height, width), dtype=np.int32), rows, starts, ends, components + 1)
+    return labels, stats
+
+
+def _merge_runs(rows, starts, ends, width):
+    """
+    Join overlapping and adjacent runs of the same rows
+    :return: tuple of int arrays (rows, starts, ends) ordered by rows and starts
+    """
+    if not len(rows):
+        return rows, starts, ends
+
+    # keys of runs of different rows never touch, since runs end not farther than width
+    row_length = width + 1
+    start_keys = rows * row_length + starts
+    order = np.argsort(start_keys, kind='stable')
+    start_keys = start_keys[order]
+    max_end_keys = np.maximum.accumulate((rows * row_length + ends)[order])
+
+    is_first = np.ones(len(start_keys), dtype=bool)
+    is_first[1:] = start_keys[1:] > max_end_keys[:-1]
+    first = np.flatnonzero(is_first)
+    last = np.append(first[1:] - 1, len(start_keys) - 1)
+    rows = start_keys[first] // row_length
+    return rows, start_keys[first] - rows * row_length, max_end_keys[last] - rows * row_length
+
+
+class RunLengthImage:
+    """
+    Black and white image stored as horizontal runs of black pixels, like get_runs gives them.
+    Morphological operations and labeling work with runs only, so their time and memory depend on amount of
+    black pixels rather than on image area. Results are the same as of dense functions.
+    """
+    __slots__ = ('rows', 'starts', 'ends', 'size')
+
+    def __init__(self, rows, starts, ends, size):
+        """
+        :param rows: int array of run rows, runs are ordered by rows and starts and do not touch each other
+        :param starts: int array of run starts
+        :param ends: int array of exclusive run ends
+        :param size: (width, height) of image
+        """
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.size = tuple(size)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        :param mask: 2-D bool array, True for black pixels
+        :return: RunLengthImage object
+        """
+        return cls(*get_runs(mask), mask.shape[::-1])
+
+    def to_mask(self):
+        """
+        :return: 2-D bool array indexed as [y, x], True for black pixels
+        """
+        return fill_runs(np.zeros(self.size[::-1], dtype=bool), self.rows, self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def area(self):
+        """
+        :return: number of black pixels
+        """
+        return int((self.ends - self.starts).sum())
+
+    def invert(self):
+        """
+        :return: RunLengthImage object with runs of white pixels
+        """
+        width, height = self.size
+        all_rows = np.arange(height, dtype=np.int64)
+        # each row has one more white run than black ones, white runs lie between ends and starts of black runs
+        start_keys = np.concatenate([all_rows * (width + 1), self.rows * (width + 1) + self.ends])
+        end_keys = np.concatenate([self.rows * (width + 1) + self.starts, all_rows * (width + 1) + width])
+        start_keys.sort()
+        end_keys.sort()
+        rows = start_keys // (width + 1)
+        starts, ends = start_keys - rows * (width + 1), end_keys - rows * (width + 1)
+        not_empty = starts < ends
+        return RunLengthImage(rows[not_empty], starts[not_empty], ends[not_empty], self.size)
+
+    def dilate(self, kernel=3, shape='square', iterations=1):
+        """
+        Binary dilation, see tools.dilate. Each run is widened by each row of structuring element
+        and overlapping runs are joined.
+        :param kernel: size of element (see get_structuring_element) or 2-D bool array of element itself
+        :param shape: shape of element when kernel is given by size
+        :param iterations: number of times dilation is applied
+        :return: new RunLengthImage object
+        """
+        element = _get_element(kernel, shape)
+        element_rows, element_starts, element_ends = get_runs(element)
+        # pixel is black if pixel shifted by an element offset is black, so runs are shifted back
+        y_offsets = (element_rows - element.shape[0] // 2).tolist()
+        x_min_offsets = (element_starts - element.shape[1] // 2).tolist()
+        x_max_offsets = (element_ends - 1 - element.shape[1] // 2).tolist()
+
+        width, height = self.size
+        result = self
+        for _ in range(iterations):
+            rows = np.concatenate([result.rows - y_offset for y_offset in y_offsets] + [result.rows[:0]])
+            starts = np.concatenate([result.starts - x_offset for x_offset in x_max_offsets] + [result.starts[:0]])
+            ends = np.concatenate([result.ends - x_offset for x_offset in x_min_offsets] + [result.ends[:0]])
+            starts, ends = np.maximum(starts, 0), np.minimum(ends, width)
+            inside = (rows >= 0) & (rows < height) & (starts < ends)
+            result = RunLengthImage(*_merge_runs(rows[inside], starts[inside], ends[inside], width), self.size)
+        return result
+
+    def erode(self, kernel=3, shape='square', iterations=1):
+        """
+        Binary erosion, see tools.erode
+        :return: new RunLengthImage object
+        """
+        return self.invert().dilate(_get_element(kernel, shape), iterations=iterations).invert()
+
+    def opening(self, kernel=3, shape='square', iterations=1):
+        """
+        Binary opening, see tools.opening
+        :return: new RunLengthImage object
+        """
+        element = _get_element(kernel, shape)
+        return self.erode(element, iterations=iterations).dilate(_reflect(element), iterations=iterations)
+
+    def label(self):
+        """
+        Find 8-connected components of runs
+        :return: tuple (int array of component index of each run, stats), stats are like of label_components
+        """
+        components, count = label_runs(self.rows, self.starts, self.ends, self.size[0])
+        return components, get_run_stats(self.rows, self.starts, self.ends, components, count, self.size)
+
+
+def get_row_distances(mask):
+    """
+    Find distance from each pixel to the nearest black pixel of the same row
+    :param mask: bool array with shape (..., height, width), True for black pixels
+    :return: float array of the same shape, inf for rows without black pixels
+    """
+    width = mask.shape[-1]
+    columns = np.arange(width, dtype=np.float64)
+
+    last_black = np.maximum.accumulate(np.where(mask, columns, -np.inf), axis=-1)
+    next_black = np.minimum.accumulate(np.where(mask, columns, np.inf)[..., ::-1], axis=-1)[..., ::-1]
+    return np.minimum(columns - last_black, next_black - columns)
+
+
+def get_l1_distances(mask, row_distances=None):
+    """
+    Find distance in metric r = x + y from each pixel to the nearest black pixel
+    :param mask: bool array with shape (..., height, width), True for black pixels,
+        it may be None if row_distances are given
+    :param row_distances: result of get_row_distances for mask, if it is already known
+    :return: float array of the same shape, inf if there are no black pixels
+    """
+    distances = get_row_distances(mask) if row_distances is None else row_distances.copy()
+    height = distances.shape[-2]
+
+    for y in range(1, height):
+        np.minimum(distances[..., y, :], distances[..., y - 1, :] + 1, out=distances[..., y, :])
+    for y in range(height - 2, -1, -1):
+        np.minimum(distances[..., y, :], distances[..., y + 1, :] + 1, out=distances[..., y, :])
+    return distances
+
+
+def get_band_distances(row_distances, half_height):
+    """
+    Find horizontal distance from each pixel to the nearest black pixel
+    whose row differs by no more than half_height
+    :param row_distances: result of get_row_distances with shape (..., height, width)
+    :param half_height: half height of band
+    :return: float array of the same shape
+    """
+    distances = row_distances.copy()
+    height = row_distances.shape[-2]
+
+    for offset in range(1, min(half_height, height - 1) + 1):
+        np.minimum(distances[..., offset:, :], row_distances[..., :-offset, :], out=distances[..., offset:, :])
+        np.minimum(distances[..., :-offset, :], row_distances[..., offset:, :], out=distances[..., :-offset, :])
+    return distances
 
 
 def get_neighbours(pixel):
@@ -155,6 +779,8 @@ def get_ellipse_pixels(x_min, y_min, x_max, y_max):
     :param y_max: y value of right bottom point of bbox
     :return: list of ellipse pixels 
     """
+    from PIL import ImageDraw
+
     _img = Image.new('RGB', (x_max+1, y_max+1), WHITE)
     _draw = ImageDraw.Draw(_img)
 
@@ -167,6 +793,8 @@ def get_ellipse_pixels(x_min, y_min, x_max, y_max):
 
 
 def get_A_slopping_lines_pixels(x_min, y_min, x_max, y_max):
+    from PIL import ImageDraw
+
     _img = Image.new('RGB', (x_max, y_max), WHITE)
     _draw = ImageDraw.Draw(_img)
 